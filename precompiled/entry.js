@@ -1,11 +1,10 @@
 var $ = require("jquery");
-require("bootstrap");
 require("bootstrap/dist/css/bootstrap.css");
 var React = require("react");
 var ReactDOM = require("react-dom");
-require("font-awesome-webpack");
+require("font-awesome/css/font-awesome.css");
 var update = require('react-addons-update');
-var _ = require('lodash');
+var extend = require('lodash/assignIn');
 
 
 class App extends React.Component {
@@ -84,7 +83,7 @@ class App extends React.Component {
             },
             success: function(data) {
                 var itemIdx = this.findIndex(item);
-                var orderClone = _.extend({}, this.state.order);
+                var orderClone = extend({}, this.state.order);
                 orderClone.items[itemIdx] = data;
                 this.setState({"order": orderClone});
             }.bind(this)
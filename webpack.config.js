@@ -1,12 +1,18 @@
 var webpack = require('webpack');
-var HtmlWebpackPlugin = require('html-webpack-plugin');
 var ExtractTextPlugin = require('extract-text-webpack-plugin');
 
+// Output goes to compiled/ under plain names, "manage.py collectstatic" then
+// fingerprints and precompresses it together with the other static files,
+// see widget/assets.py. Libraries are split into their own chunk, so a
+// deploy that only changes the app leaves the vendor files cached.
 module.exports = {
-    entry: './precompiled/entry.js',
+    entry: {
+        app: './precompiled/entry.js',
+        vendor: ['jquery', 'react', 'react-dom', 'react-addons-update', 'lodash/assignIn']
+    },
     output: {
         path: __dirname + '/compiled',
-        filename: 'bundle.js'
+        filename: '[name].js'
     },
     module: {
         loaders: [
@@ -20,23 +26,20 @@ module.exports = {
             },
             {
                 test: /\.css$/,
-                loader: "style-loader!css-loader"
-            },
-            {
-                test: /\.(ttf|eot|svg)(\?v=[0-9]\.[0-9]\.[0-9])?$/,
-                loader: "file-loader"
+                loader: ExtractTextPlugin.extract({fallback: "style-loader", use: "css-loader"})
             },
             {
-                test: /\.woff(2)?(\?v=[0-9]\.[0-9]\.[0-9])?$/,
-                loader: "url-loader?limit=30000&minetype=application/font-woff"
+                test: /\.(ttf|eot|svg|woff2?)(\?v=[0-9]\.[0-9]\.[0-9])?$/,
+                loader: "file-loader?name=fonts/[name].[ext]"
             }
         ]
     },
     plugins: [
-        new webpack.ProvidePlugin({
-            $: "jquery",
-            jQuery: "jquery",
-            lodash: "lodash"
-        }),
+        new ExtractTextPlugin('[name].css'),
+        // Module ids from their paths rather than their order, so vendor.js
+        // does not change with the app's modules
+        new webpack.HashedModuleIdsPlugin(),
+        // The webpack runtime goes to runtime.js, it changes with every build
+        new webpack.optimize.CommonsChunkPlugin({names: ['vendor', 'runtime'], minChunks: Infinity})
     ]
 };
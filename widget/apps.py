@@ -0,0 +1,11 @@
+import importlib
+
+from django.apps import AppConfig
+
+
+class WidgetConfig(AppConfig):
+    name = "widget"
+
+    def ready(self):
+        # Connects the receivers that keep the in-process catalog indexes current
+        importlib.import_module("widget.signals")
@@ -0,0 +1,124 @@
+"""
+Static files under names with a hash of their content, precompressed and
+cached by browsers for good.
+
+"manage.py collectstatic" copies the app's static files and the webpack
+output in compiled/ to STATIC_ROOT under hashed names and writes gzip and,
+with the brotli package installed, brotli variants next to them.
+static_asset serves the smallest variant a request accepts. A file under a
+hashed name never changes, a new version gets a new name, so it is cached
+for a year.
+"""
+import gzip
+import io
+import mimetypes
+import posixpath
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+from django.http import Http404
+from django.utils.cache import patch_vary_headers
+from django.utils.functional import cached_property
+from django.views import static
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files worth compressing, woff and woff2 fonts and images are compressed already
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".json", ".map", ".svg", ".txt", ".html", ".ttf", ".eot")
+
+# Content-Encoding and file suffix of the variants, preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+CACHE_FOREVER = "public, max-age=31536000, immutable"
+
+
+def compress(content):
+    """
+    The variants of `content` by encoding, leaving out those that are not
+    smaller than `content` itself.
+    """
+    buffer = io.BytesIO()
+    # A fixed mtime keeps the output the same from one build to the next
+    with gzip.GzipFile(filename="", mode="wb", fileobj=buffer, compresslevel=9, mtime=0) as out:
+        out.write(content)
+    variants = {"gzip": buffer.getvalue()}
+    if brotli is not None:
+        variants["br"] = brotli.compress(content)
+    return dict((encoding, data) for encoding, data in variants.items() if len(data) < len(content))
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ManifestStaticFilesStorage that also writes the compressed variants of
+    every hashed file it collects.
+    """
+    def post_process(self, paths, dry_run=False, **options):
+        for result in super(CompressedManifestStaticFilesStorage, self).post_process(paths, dry_run, **options):
+            yield result
+        self.__dict__.pop("hashed_names", None)
+        if dry_run:
+            return
+        for name in self.hashed_names:
+            if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                self.write_variants(name)
+
+    def write_variants(self, name):
+        with self.open(name) as original:
+            variants = compress(original.read())
+        for encoding, suffix in ENCODINGS:
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            if encoding in variants:
+                self._save(name + suffix, ContentFile(variants[encoding]))
+
+    @cached_property
+    def hashed_names(self):
+        return frozenset(self.hashed_files.values())
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        encoding, _, params = part.partition(";")
+        params = params.replace(" ", "")
+        try:
+            if params.startswith("q=") and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def static_asset(request, path):
+    """
+    Serves a file collected to STATIC_ROOT, as the smallest precompressed
+    variant the request accepts. Files under a hashed name are cached for a
+    year, anything else is revalidated on every use.
+    """
+    path = posixpath.normpath(path).lstrip("/")
+    response = None
+    accepted = accepted_encodings(request)
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted:
+            try:
+                response = static.serve(request, path + suffix, document_root=settings.STATIC_ROOT)
+            except Http404:
+                continue
+            response["Content-Encoding"] = encoding
+            response["Content-Type"] = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            break
+    if response is None:
+        response = static.serve(request, path, document_root=settings.STATIC_ROOT)
+
+    if path.endswith(COMPRESSIBLE_EXTENSIONS):
+        patch_vary_headers(response, ("Accept-Encoding",))
+    if path in getattr(staticfiles_storage, "hashed_names", ()):
+        response["Cache-Control"] = CACHE_FOREVER
+    else:
+        response["Cache-Control"] = "no-cache"
+    return response
@@ -0,0 +1,237 @@
+"""
+Helpers shared by the benchmark management commands.
+"""
+import math
+import random
+import threading
+import time
+
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+from django.db import connection
+from django.utils.six.moves import queue
+from django.test.utils import CaptureQueriesContext
+
+from widget.cache import bump_generation
+from widget.index import reset_indexes
+from widget.models import Category, Feature, Widget
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of `samples`, which must be sorted.
+    """
+    if not samples:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(samples))) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+def summarize(latencies, elapsed):
+    """
+    Latency percentiles in milliseconds and throughput for timings in seconds.
+    """
+    latencies = sorted(latencies)
+    summary = {
+        "count": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else None,
+    }
+    for pct in (50, 95, 99):
+        value = percentile(latencies, pct)
+        summary["p%s" % pct] = value * 1000 if value is not None else None
+    return summary
+
+
+def format_summary(summary):
+    return "%(count)6d requests  %(throughput)8.1f/s  p50 %(p50)7.2fms  p95 %(p95)7.2fms  p99 %(p99)7.2fms" % summary
+
+
+def measure_renderers(data, renderers, repeat=5):
+    """
+    Size in bytes and best encode time in milliseconds of `data` with each
+    renderer, by format.
+    """
+    results = {}
+    for renderer in renderers:
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            content = renderer.render(data)
+            timings.append(time.time() - start)
+        results[renderer.format] = {"bytes": len(content), "encode_ms": min(timings) * 1000}
+    return results
+
+
+def generate_catalog(categories, features_per_category, widgets, features_per_widget, seed=0):
+    """
+    Fills the database with a synthetic catalog. Rows are written with
+    bulk_create, which skips the model signals, so the catalog generation is
+    bumped once at the end instead.
+    """
+    rng = random.Random(seed)
+    Category.objects.bulk_create([
+        Category(name="category-%s" % c, label="Category %s" % c) for c in range(categories)
+    ])
+    category_names = list(Category.objects.order_by("id").values_list("id", "name"))
+    category_ids = [category_id for category_id, name in category_names]
+    Feature.objects.bulk_create([
+        Feature(label="feature-%s-%s" % (c, f), category_id=category_id)
+        for c, category_id in enumerate(category_ids) for f in range(features_per_category)
+    ])
+    features = {}
+    for feature_id, category_id in Feature.objects.values_list("id", "category_id"):
+        features.setdefault(category_id, []).append(feature_id)
+
+    rows = []
+    for w in range(widgets):
+        category_id, category_name = rng.choice(category_names)
+        rows.append(Widget(
+            name="widget-%s" % w,
+            description="Synthetic widget number %s" % w,
+            category_id=category_id,
+            category_name=category_name,
+            price="%d.%02d" % (rng.randint(1, 500), rng.randint(0, 99)),
+            # A quarter of the widgets have limited stock
+            quantity=rng.randint(1000, 10000) if rng.random() < 0.25 else None,
+        ))
+    Widget.objects.bulk_create(rows, batch_size=500)
+    through = Widget.features.through
+    rows = []
+    for widget_id, category_id in Widget.objects.values_list("id", "category_id"):
+        choices = features.get(category_id, [])
+        for feature_id in rng.sample(choices, min(features_per_widget, len(choices))):
+            rows.append(through(widget_id=widget_id, feature_id=feature_id))
+    through.objects.bulk_create(rows, batch_size=500)
+    # The rows are not in the change log
+    reset_indexes()
+    bump_generation()
+
+
+class Scenario(object):
+    """
+    One benchmarked endpoint. `prepare` runs untimed before every request and
+    returns whatever `request` needs, `request` makes the call with the test
+    client and returns the response.
+    """
+    def __init__(self, name, request, prepare=None, expected_status=200):
+        self.name = name
+        self.request = request
+        self.prepare = prepare or (lambda: None)
+        self.expected_status = expected_status
+
+
+def run_scenario(client, scenario, requests, warmup):
+    for _ in range(warmup):
+        scenario.request(client, scenario.prepare())
+
+    latencies = []
+    queries = 0
+    total = 0.0
+    for _ in range(requests):
+        state = scenario.prepare()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.time()
+            response = scenario.request(client, state)
+            if response.streaming:
+                # Streamed bodies are only produced as they are read
+                for _ in response.streaming_content:
+                    pass
+            latency = time.time() - start
+        if response.status_code != scenario.expected_status:
+            raise AssertionError("%s returned %s: %s" % (scenario.name, response.status_code, response.content[:200]))
+        latencies.append(latency)
+        queries += len(captured)
+        total += latency
+
+    summary = summarize(latencies, total)
+    summary["queries"] = float(queries) / requests
+    return summary
+
+
+def compare(baseline, results):
+    """
+    Rows of (scenario, metric, baseline value, current value, change in %).
+    """
+    rows = []
+    for name, summary in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in ("p50", "p95", "p99", "throughput", "queries"):
+            before, after = baseline[name].get(metric), summary.get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) * 100.0 / before if before else 0.0
+            rows.append((name, metric, before, after, change))
+    return rows
+
+
+def explain(queryset):
+    """
+    The database's query plan for `queryset`, one string per plan row.
+    """
+    sql, params = queryset.query.sql_with_params()
+    prefix = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [" ".join(str(column) for column in row) for row in cursor.fetchall()]
+
+
+def time_query(queryset, repeat):
+    """
+    Median time in milliseconds to fetch `queryset`.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        list(queryset.all())
+        timings.append(time.time() - start)
+    return percentile(sorted(timings), 50) * 1000
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    Serves connections on a fixed number of worker threads, the way a
+    threaded application server process does. Accepted connections wait in a
+    queue while every worker is busy, including busy waiting on a slow client.
+    """
+    def __init__(self, address, application, threads):
+        WSGIServer.__init__(self, address, QuietRequestHandler)
+        self.set_app(application)
+        self.connections = queue.Queue()
+        self.workers = [threading.Thread(target=self.work) for _ in range(threads)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+
+    def work(self):
+        try:
+            while True:
+                request, client_address = self.connections.get()
+                if request is None:
+                    return
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+        finally:
+            connection.close()
+
+    def handle_error(self, request, client_address):
+        # Clients that gave up are counted by the benchmark instead
+        pass
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        for _ in self.workers:
+            self.connections.put((None, None))
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,307 @@
+import hashlib
+import threading
+import time
+import weakref
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+from widget.changes import latest_seq, record_change
+
+GENERATION_KEY = "widget:catalog:generation"
+HITS_KEY = "widget:catalog:hits"
+MISSES_KEY = "widget:catalog:misses"
+
+# Response headers that are replayed when a cached response is served
+CACHED_HEADERS = ("Content-Type", "Allow", "Vary")
+
+# Formats of the responses that are cached. Browsable API pages are not, they
+# are rendered for one user and carry their CSRF token.
+CACHED_FORMATS = ("json", "csv", "msgpack")
+
+# In-process structures derived from the catalog, see `follow`
+_followers = []
+
+# The CatalogCommits of the transaction each thread is in, see
+# `on_catalog_commit`
+_transaction = threading.local()
+
+# When this process last read the change sequence and what it was, see
+# `check_changes`
+_last_check = {"time": 0.0, "seq": None}
+
+
+def get_cache():
+    return caches[settings.WIDGET_CACHE_ALIAS]
+
+
+def generation():
+    """
+    The current catalog generation. Every cached catalog response is keyed on
+    it, so bumping it makes all of them unreachable at once.
+    """
+    cache = get_cache()
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        # Start from the clock rather than 1 so that losing the key to culling
+        # can never bring back responses cached under an older generation.
+        cache.add(GENERATION_KEY, int(time.time() * 1000), None)
+        value = cache.get(GENERATION_KEY)
+    return value
+
+
+def bump_generation(missed=False):
+    """
+    Bumps the generation. With `missed`, for changes the followers have not
+    been told about, which they then read from the change log.
+    """
+    generation()
+    try:
+        new_generation = get_cache().incr(GENERATION_KEY)
+    except ValueError:
+        new_generation = generation()
+    for follower in _followers:
+        follower.follow(new_generation, missed)
+    return new_generation
+
+
+class CatalogCommit(object):
+    """
+    What a stretch of a transaction did to the catalog, run once it commits:
+    the index changes in order and then, after the last stretch that was not
+    rolled back, the generation bump.
+
+    A stretch ends where the transaction enters or leaves an atomic block, so
+    each is registered with transaction.on_commit in its own savepoint and is
+    dropped with it when that is rolled back. Only weak references to them
+    are kept, a dropped one is gone right away.
+    """
+
+    def __init__(self, savepoints):
+        self.savepoints = savepoints
+        self.funcs = []
+        self.changed = False
+        self.done = False
+
+    def add(self, func, changed):
+        if func is not None:
+            self.funcs.append(func)
+        self.changed = self.changed or changed
+
+    def __call__(self):
+        self.done = True
+        for func in self.funcs:
+            func()
+        if self.changed:
+            _transaction.changed = True
+        if getattr(_transaction, "changed", False) and not pending_commits():
+            _transaction.changed = False
+            bump_generation()
+
+
+def pending_commits():
+    """
+    The CatalogCommits of the current transaction that are still to run.
+    """
+    commits = [ref() for ref in getattr(_transaction, "commits", ())]
+    return [commit for commit in commits if commit is not None and not commit.done]
+
+
+def on_catalog_commit(func=None, changed=False):
+    """
+    Runs `func` once the surrounding transaction commits, in order with the
+    other index changes and before the generation is bumped, which `changed`
+    asks for. Outside of a transaction both happen at once.
+    """
+    # Blocks without a savepoint can only be rolled back with the transaction
+    savepoints = tuple(sid for sid in transaction.get_connection().savepoint_ids if sid is not None)
+    commits = pending_commits()
+    if commits and commits[-1].savepoints == savepoints:
+        commits[-1].add(func, changed)
+        return
+    if not commits:
+        _transaction.changed = False
+    commit = CatalogCommit(savepoints)
+    commit.add(func, changed)
+    _transaction.commits = [weakref.ref(pending) for pending in commits + [commit]]
+    transaction.on_commit(commit)
+
+
+def catalog_changed():
+    """
+    Called whenever a widget, category or feature changes, after the indexes
+    were given the change. The generation is bumped once the surrounding
+    transaction commits, after the indexes applied it, and a change that is
+    rolled back leaves it alone. However many changes the transaction makes,
+    it bumps the generation once, after the indexes applied all of them.
+    """
+    on_catalog_commit(changed=True)
+
+
+def invalidate():
+    """
+    Drops the cached catalog responses of every process. The change is
+    logged, so processes that do not share the cache notice it in
+    check_changes once it has settled, see widget.changes.
+    """
+    with transaction.atomic():
+        record_change("widget")
+        catalog_changed()
+
+
+def check_changes():
+    """
+    Notices changes committed by processes that do not share the cache, such
+    as with the default LocMemCache, by reading the change sequence at most
+    every WIDGET_CHANGE_CHECK_INTERVAL seconds. When it moved the generation
+    is bumped as missed. Called before catalog reads.
+    """
+    now = time.time()
+    if now - _last_check["time"] < settings.WIDGET_CHANGE_CHECK_INTERVAL or uncommitted_changes():
+        return
+    _last_check["time"] = now
+    seq = latest_seq()
+    if seq != _last_check["seq"]:
+        if _last_check["seq"] is not None:
+            bump_generation(missed=True)
+        _last_check["seq"] = seq
+
+
+def uncommitted_changes():
+    """
+    Whether the current transaction has changed the catalog. Until it
+    commits, its view of the catalog is its own and must not be cached.
+    """
+    return bool(pending_commits())
+
+
+def register_follower(follower):
+    """
+    Registers an in-process structure that is kept current incrementally.
+    Its `follow(generation, missed)` is called after every bump so it can
+    tell its own updates apart from changes made by other processes.
+    """
+    _followers.append(follower)
+
+
+def increment(key):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def stats():
+    """
+    The generation and the hit and miss counters of the cached catalog
+    views. They are kept in the cache, so with a cache that is not shared,
+    such as the default LocMemCache, they are those of this process.
+    """
+    cache = get_cache()
+    return {
+        "generation": generation(),
+        "hits": cache.get(HITS_KEY, 0),
+        "misses": cache.get(MISSES_KEY, 0),
+    }
+
+
+def catalog_key(request, view_kwargs):
+    params = []
+    for name, values in sorted(request.GET.lists()):
+        if name == "features":
+            values = [value.lower() for value in values]
+        params.append((name, sorted(values)))
+    key = repr((sorted(view_kwargs.items()), params, request.META.get("HTTP_ACCEPT", "")))
+    return "widget:catalog:%s:%s" % (generation(), hashlib.md5(key.encode("utf-8")).hexdigest())
+
+
+def cached_catalog_value(name, params, compute):
+    """
+    Returns `compute()`, cached under `name` and `params` until the catalog
+    changes.
+    """
+    check_changes()
+    cache = get_cache()
+    key = "widget:catalog:%s:%s:%s" % (generation(), name, hashlib.md5(repr(params).encode("utf-8")).hexdigest())
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, settings.WIDGET_CACHE_TIMEOUT)
+    return value
+
+
+def cacheable(request, response):
+    """
+    Whether `response` is the same for every client, so it can be stored.
+    Responses setting or depending on a cookie are not.
+    """
+    renderer = getattr(response, "accepted_renderer", None)
+    if renderer is not None and renderer.format not in CACHED_FORMATS:
+        return False
+    if response.cookies or request.META.get("CSRF_COOKIE_USED"):
+        return False
+    vary = [value.strip().lower() for value in response.get("Vary", "").split(",")]
+    return "cookie" not in vary
+
+
+def etag_matches(etag, if_none_match):
+    """
+    Whether an If-None-Match header names `etag`, or any with "*". Tags are
+    compared whole and, as for If-None-Match, weakly.
+    """
+    tags = parse_etags(if_none_match)
+    if "*" in tags:
+        return True
+
+    def opaque(tag):
+        return tag[2:] if tag.startswith("W/") else tag
+    return opaque(etag) in [opaque(tag) for tag in tags]
+
+
+def cached_catalog_view(view):
+    """
+    Caches rendered GET responses of a catalog view until the catalog changes,
+    in the formats of CACHED_FORMATS. Responses carry an ETag and conditional GETs are answered with a 304.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD") or not settings.WIDGET_CACHE_RESPONSES or uncommitted_changes():
+            return view(request, *args, **kwargs)
+
+        check_changes()
+        cache = get_cache()
+        key = catalog_key(request, kwargs)
+        entry = cache.get(key)
+        if entry is None:
+            increment(MISSES_KEY)
+            response = view(request, *args, **kwargs)
+            if hasattr(response, "render"):
+                response.render()
+            if response.status_code != 200 or response.streaming or not cacheable(request, response):
+                return response
+            headers = dict((name, response[name]) for name in CACHED_HEADERS if response.has_header(name))
+            # Views may set their own ETag, such as a row version
+            etag = response.get("ETag") or '"%s"' % hashlib.md5(response.content).hexdigest()
+            cache.set(key, (response.content, headers, etag), settings.WIDGET_CACHE_TIMEOUT)
+            response["X-Cache"] = "MISS"
+        else:
+            increment(HITS_KEY)
+            content, headers, etag = entry
+            response = HttpResponse(content)
+            for name, value in headers.items():
+                response[name] = value
+            response["X-Cache"] = "HIT"
+
+        response["ETag"] = etag
+        if etag_matches(etag, request.META.get("HTTP_IF_NONE_MATCH", "")):
+            not_modified = HttpResponseNotModified()
+            not_modified["ETag"] = etag
+            return not_modified
+        return response
+    return wrapper
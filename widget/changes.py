@@ -0,0 +1,102 @@
+"""
+Change tracking for delta sync. Every change to the catalog is logged in
+CatalogChange, whose id is its sequence number, and that number is stamped on
+the objects it touched, so mirrors can ask for everything after the last
+number they saw.
+
+Numbers are taken when the change is written, not when it commits, so a
+transaction can still commit a change numbered below others that are already
+visible. Writers take no shared lock for it. Instead readers only go as far
+as the settled sequence number (see latest_seq): every change recorded more
+than WIDGET_CHANGE_SETTLE_TIME seconds ago, by the database clock, has been
+committed or rolled back, as long as no transaction stays open that long
+after recording a change. sqlite runs one writer at a time, so there numbers
+are taken in commit order and nothing needs to settle.
+
+The log is compacted after WIDGET_CHANGE_RETENTION_DAYS (see compact_changes).
+A sequence number older than what is left (see oldest_seq) can no longer be
+caught up from, its holder has to read everything again.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import Now
+
+from widget.models import CatalogChange, Category, Feature, Widget
+
+KINDS = (("category", Category), ("feature", Feature), ("widget", Widget))
+
+
+def record_change(kind, object_id=None, deleted=False):
+    """
+    Logs a change and returns its sequence number.
+    """
+    return CatalogChange.objects.create(kind=kind, object_id=object_id, deleted=deleted, recorded=Now()).id
+
+
+def stamp(queryset, seq):
+    queryset.update(change_seq=seq)
+
+
+def stamp_widgets(queryset, seq, **values):
+    """
+    Stamps widgets whose representation changed without a save, which also
+    moves them to a new row version, see widget.versioning. `values` are
+    written along.
+    """
+    queryset.update(change_seq=seq, version=F("version") + 1, **values)
+
+
+def latest_seq():
+    """
+    The settled sequence number: no change numbered up to it can still be
+    committed. Changes above it may already be visible, they are sent again
+    after the next poll.
+    """
+    changes = CatalogChange.objects.order_by("-id")
+    if settings.WIDGET_CHANGE_SETTLE_TIME:
+        # Walks back from the newest change, so only reads the unsettled ones
+        changes = changes.filter(recorded__lte=Now() - timedelta(seconds=settings.WIDGET_CHANGE_SETTLE_TIME))
+    return changes.values_list("id", flat=True).first() or 0
+
+
+def oldest_seq():
+    """
+    The oldest sequence number changes can still be read after. Changes up
+    to it may have been compacted away, deletes among them included.
+    """
+    first = CatalogChange.objects.order_by("id").values_list("id", flat=True).first()
+    return first - 1 if first else 0
+
+
+def compact_changes(days):
+    """
+    Deletes the changes recorded more than `days` ago and returns how many.
+    The objects keep their change_seq, only deletes older than that are
+    forgotten. The newest change is always kept, so that the sequence number
+    never goes back.
+    """
+    newest = CatalogChange.objects.order_by("-id").values_list("id", flat=True).first()
+    old = CatalogChange.objects.filter(recorded__lt=Now() - timedelta(days=days)).exclude(id=newest)
+    return old.delete()[0]
+
+
+def changes_since(since):
+    """
+    The changed objects as querysets per kind and the ids deleted per kind,
+    after sequence number `since`, or everything when it is None.
+    """
+    changed = {}
+    for kind, model in KINDS:
+        objects = model.objects.all()
+        if since is not None:
+            objects = objects.filter(change_seq__gt=since)
+        changed[kind] = objects.order_by("change_seq", "id")
+
+    deleted = dict((kind, []) for kind, model in KINDS)
+    if since is not None:
+        tombstones = CatalogChange.objects.filter(id__gt=since, deleted=True).order_by("id")
+        for kind, object_id in tombstones.values_list("kind", "object_id"):
+            deleted[kind].append(object_id)
+    return changed, deleted
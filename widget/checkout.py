@@ -0,0 +1,122 @@
+"""
+Queued checkout. With WIDGET_CHECKOUT_QUEUE on, order_complete only records a
+CheckoutJob and answers with its id, and "manage.py checkout_worker" completes
+the queued orders in batches. A batch takes stock with one conditional
+UPDATE per widget for the quantities of all of its orders together, instead
+of every checkout waiting for the write lock with its own transaction.
+"""
+import json
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from widget.models import CheckoutJob, Order, OrderItem
+from widget.stock import reserve_stock
+
+ALREADY_COMPLETED = {"non_field_errors": ["Order is already completed"]}
+
+
+def order_demand(lines):
+    """
+    Widget id -> quantity for order item (id, widget id, quantity) lines.
+    """
+    demand = defaultdict(int)
+    for _, widget_id, quantity in lines:
+        demand[widget_id] += quantity
+    return dict(demand)
+
+
+def stock_errors(lines, short):
+    """
+    The errors of a checkout that failed for the widgets in `short`.
+    """
+    return {
+        "non_field_errors": ["Not enough stock to fulfill order"],
+        "items": [item_id for item_id, widget_id, _ in lines if widget_id in short],
+    }
+
+
+def enqueue_checkout(order):
+    """
+    Queues `order` for completion. Returns the job and whether it was created,
+    which it is not if the order was already queued, or (None, False) if the
+    order is completed. A failed job is replaced, so a checkout can be retried
+    after changing the order.
+    """
+    if order.completed:
+        return None, False
+    with transaction.atomic():
+        CheckoutJob.objects.filter(order=order, status=CheckoutJob.FAILED).delete()
+        try:
+            with transaction.atomic():
+                return CheckoutJob.objects.create(order=order), True
+        except IntegrityError:
+            return CheckoutJob.objects.get(order=order), False
+
+
+def process_jobs(batch_size):
+    """
+    Completes up to `batch_size` pending jobs, oldest first, in one
+    transaction and returns how many were processed.
+
+    Stock for the whole batch is first reserved in one go. Only if some widget
+    runs short are the jobs reserved one by one, in queue order, so that the
+    ones that still fit complete and the rest fail as they would have alone.
+    """
+    pending = list(
+        CheckoutJob.objects.filter(status=CheckoutJob.PENDING).order_by("id").values_list("id", flat=True)[:batch_size]
+    )
+    if not pending:
+        return 0
+
+    now = timezone.now()
+    with transaction.atomic():
+        # Claiming the jobs is the first statement and a write, so on sqlite the
+        # batch holds the write lock from the start instead of failing to
+        # upgrade a read. Jobs another worker completed in the meantime are no
+        # longer pending and are not claimed.
+        if not CheckoutJob.objects.filter(id__in=pending, status=CheckoutJob.PENDING).update(finished=now):
+            return 0
+        jobs = list(CheckoutJob.objects.filter(id__in=pending, status=CheckoutJob.PENDING).order_by("id"))
+
+        order_ids = [job.order_id for job in jobs]
+        open_orders = set(Order.objects.filter(id__in=order_ids, completed=False).values_list("id", flat=True))
+        lines = defaultdict(list)
+        for item_id, order_id, widget_id, quantity in (
+            OrderItem.objects.filter(order_id__in=order_ids).values_list("id", "order_id", "widget_id", "quantity")
+        ):
+            lines[order_id].append((item_id, widget_id, quantity))
+
+        errors = {}
+        ready = []
+        for job in jobs:
+            if job.order_id in open_orders:
+                ready.append(job)
+            else:
+                errors[job.id] = ALREADY_COMPLETED
+
+        batch = transaction.savepoint()
+        if reserve_stock(order_demand(line for job in ready for line in lines[job.order_id])):
+            transaction.savepoint_rollback(batch)
+            for job in ready:
+                single = transaction.savepoint()
+                short = reserve_stock(order_demand(lines[job.order_id]))
+                if short:
+                    transaction.savepoint_rollback(single)
+                    errors[job.id] = stock_errors(lines[job.order_id], short)
+                else:
+                    transaction.savepoint_commit(single)
+        else:
+            transaction.savepoint_commit(batch)
+
+        completed = [job for job in ready if job.id not in errors]
+        Order.objects.filter(id__in=[job.order_id for job in completed]).update(completed=True)
+        CheckoutJob.objects.filter(id__in=[job.id for job in completed]).update(status=CheckoutJob.DONE, finished=now)
+        for job in jobs:
+            if job.id in errors:
+                job.status = CheckoutJob.FAILED
+                job.errors = json.dumps(errors[job.id])
+                job.finished = now
+                job.save(update_fields=["status", "errors", "finished"])
+    return len(jobs)
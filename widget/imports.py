@@ -0,0 +1,256 @@
+"""
+Bulk import of widgets from CSV or NDJSON.
+
+Rows are validated and written in batches. Categories and features are
+looked up by name and label from maps loaded once, widgets are matched on
+their unique name and either inserted with bulk_create or updated with one
+UPDATE statement executed for the whole batch, and their features are
+replaced with bulk inserts into the through table. Rows that fail validation
+are reported with their line number and skipped, the rest of the batch is
+still written. A batch whose write fails, for example because the same name
+was inserted concurrently, is rolled back and its rows are reported.
+"""
+import csv
+import json
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.db import IntegrityError, connection, transaction
+from django.utils import six
+from rest_framework import serializers
+
+from widget.cache import catalog_changed
+from widget.changes import record_change
+from widget.index import catch_up_indexes
+from widget.models import Widget, Category, Feature
+
+# Columns set on existing widgets
+UPDATED_FIELDS = ("description", "price", "category", "category_name", "quantity", "change_seq")
+
+# Errors kept for the report, the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+FEATURE_SEPARATOR = "|"
+
+
+def read_csv(lines):
+    """
+    Yields (line number, row) from CSV with a header row. The features of a
+    widget are one column of labels separated by "|", an empty quantity
+    means unlimited stock.
+    """
+    if not six.PY2:
+        lines = (line.decode("utf-8") if isinstance(line, bytes) else line for line in lines)
+    reader = csv.DictReader(lines)
+    for row in reader:
+        if six.PY2:
+            row = dict((key, value.decode("utf-8") if value is not None else None) for key, value in row.items())
+        features = row.get("features") or ""
+        row["features"] = [label for label in features.split(FEATURE_SEPARATOR) if label]
+        if not row.get("quantity"):
+            row["quantity"] = None
+        yield reader.line_num, row
+
+
+def read_ndjson(lines):
+    """
+    Yields (line number, row) from one JSON object per line.
+    """
+    for line_number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+
+READERS = {"csv": read_csv, "ndjson": read_ndjson}
+
+
+class WidgetImportSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=100)
+    description = serializers.CharField(max_length=1000)
+    price = serializers.DecimalField(max_digits=12, decimal_places=2, min_value=Decimal("0.01"))
+    category = serializers.CharField(max_length=100)
+    features = serializers.ListField(child=serializers.CharField(max_length=100), required=False)
+    quantity = serializers.IntegerField(min_value=0, required=False, allow_null=True)
+
+
+class ImportResult(object):
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else None
+
+    def add_error(self, line_number, errors):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_number, "errors": errors})
+
+    def as_dict(self):
+        return {
+            "rows": self.rows,
+            "created": self.created,
+            "updated": self.updated,
+            "error_count": self.error_count,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.rows_per_second, 1) if self.rows_per_second else None,
+        }
+
+
+class WidgetImporter(object):
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        # One instance validates every row, like the child of a ListSerializer,
+        # so its fields are only built once
+        self.row_serializer = WidgetImportSerializer()
+        self.categories = dict(Category.objects.values_list("name", "id"))
+        # (category id, label) -> feature id
+        self.features = dict(
+            ((category_id, label), feature_id)
+            for feature_id, category_id, label in Feature.objects.values_list("id", "category_id", "label")
+        )
+
+    def run(self, rows):
+        """
+        Imports (line number, row) pairs and returns an ImportResult.
+        """
+        result = ImportResult()
+        start = time.time()
+        batch = []
+        try:
+            for line_number, row in rows:
+                result.rows += 1
+                batch.append((line_number, row))
+                if len(batch) == self.batch_size:
+                    self.import_batch(batch, result)
+                    batch = []
+            if batch:
+                self.import_batch(batch, result)
+        finally:
+            result.seconds = time.time() - start
+            if result.created or result.updated:
+                # The writes bypassed the model signals but are in the
+                # change log
+                catch_up_indexes()
+                catalog_changed()
+        return result
+
+    def validate(self, line_number, row, result):
+        if not isinstance(row, dict):
+            result.add_error(line_number, {"non_field_errors": ["Not a JSON object."]})
+            return None
+        try:
+            data = self.row_serializer.run_validation(row)
+        except serializers.ValidationError as error:
+            result.add_error(line_number, error.detail)
+            return None
+
+        category_id = self.categories.get(data["category"])
+        if category_id is None:
+            result.add_error(line_number, {"category": ["Category does not exist."]})
+            return None
+        feature_ids = []
+        for label in data.get("features", []):
+            feature_id = self.features.get((category_id, label))
+            if feature_id is None:
+                result.add_error(line_number, {"features": ["Feature %s does not exist in this category." % label]})
+                return None
+            feature_ids.append(feature_id)
+
+        return Widget(
+            name=data["name"],
+            description=data["description"],
+            price=data["price"],
+            category_id=category_id,
+            category_name=data["category"],
+            quantity=data.get("quantity"),
+        ), feature_ids
+
+    def import_batch(self, batch, result):
+        # name -> (line number, widget, feature ids), a later row for the same name wins
+        widgets = OrderedDict()
+        for line_number, row in batch:
+            valid = self.validate(line_number, row, result)
+            if valid:
+                widgets[valid[0].name] = (line_number,) + valid
+        if not widgets:
+            return
+        try:
+            with transaction.atomic():
+                created, updated = self.write(widgets)
+        except IntegrityError as error:
+            for line_number, widget, feature_ids in widgets.values():
+                result.add_error(line_number, {"non_field_errors": ["Could not be written: %s" % error]})
+            return
+        result.created += created
+        result.updated += updated
+
+    def existing_ids(self, names):
+        return dict(Widget.objects.filter(name__in=names).values_list("name", "id"))
+
+    def write(self, widgets):
+        """
+        Writes the validated widgets of a batch and returns how many were
+        created and updated.
+        """
+        seq = record_change("widget")
+        existing = self.existing_ids(list(widgets))
+        new = [widget for name, (line_number, widget, feature_ids) in widgets.items() if name not in existing]
+        for widget in new:
+            widget.change_seq = seq
+        Widget.objects.bulk_create(new)
+        ids = dict(existing)
+        if new:
+            # bulk_create does not set primary keys on every database
+            ids.update(Widget.objects.filter(name__in=[widget.name for widget in new]).values_list("name", "id"))
+
+        updated = [(ids[name], widget) for name, (line_number, widget, feature_ids) in widgets.items() if name in existing]
+        if updated:
+            self.update(updated, seq)
+
+        through = Widget.features.through
+        through.objects.filter(widget_id__in=list(existing.values())).delete()
+        through.objects.bulk_create([
+            through(widget_id=ids[name], feature_id=feature_id)
+            for name, (line_number, widget, feature_ids) in widgets.items()
+            for feature_id in set(feature_ids)
+        ])
+        return len(new), len(updated)
+
+    def update(self, rows, seq):
+        """
+        Writes (id, widget) rows over existing widgets. Building one UPDATE
+        with CASE expressions for a batch costs more than running the same
+        statement for every row with executemany.
+        """
+        fields = [Widget._meta.get_field(name) for name in UPDATED_FIELDS]
+        quote = connection.ops.quote_name
+        version = quote(Widget._meta.get_field("version").column)
+        sql = "UPDATE %s SET %s, %s = %s + 1 WHERE %s = %%s" % (
+            quote(Widget._meta.db_table),
+            ", ".join("%s = %%s" % quote(field.column) for field in fields),
+            version,
+            version,
+            quote(Widget._meta.pk.column),
+        )
+        params = []
+        for widget_id, widget in rows:
+            widget.change_seq = seq
+            params.append(
+                [field.get_db_prep_save(getattr(widget, field.attname), connection) for field in fields] + [widget_id]
+            )
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, params)
@@ -0,0 +1,292 @@
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+
+from widget.cache import generation, on_catalog_commit, register_follower, uncommitted_changes
+from widget.changes import changes_since, latest_seq, oldest_seq
+from widget.models import Feature
+
+# Every CatalogIndex, widget.signals passes catalog changes on to all of them
+catalog_indexes = []
+
+
+def widgets_updated(widget_ids):
+    """
+    Passes on changes made with queryset updates, which send no signals.
+    """
+    widget_ids = list(widget_ids)
+    for index in catalog_indexes:
+        index.widgets_updated(widget_ids)
+
+
+def catch_up_indexes():
+    """
+    Has every index read the changes of writes that bypass the model signals
+    but record them, such as imports, from the change log once the
+    surrounding transaction commits.
+    """
+    def fall_behind():
+        for index in catalog_indexes:
+            index.fall_behind()
+    on_catalog_commit(fall_behind)
+
+
+def reset_indexes():
+    """
+    Has every index rebuilt after writes that do not even record their
+    changes, such as bulk inserts, once the surrounding transaction commits.
+    """
+    def reset():
+        for index in catalog_indexes:
+            index.reset()
+    on_catalog_commit(reset)
+
+
+def incremental(method):
+    """
+    Applies a change once the surrounding transaction commits, and only to a
+    built index. One that is not built yet reads the change from the database
+    when it is. A change that is rolled back never reaches the index.
+    """
+    @wraps(method)
+    def wrapper(self, *args):
+        def apply():
+            with self.lock:
+                if self.built:
+                    method(self, *args)
+        on_catalog_commit(apply)
+    return wrapper
+
+
+class CatalogIndex(object):
+    """
+    Base for in-process indexes over the catalog.
+
+    An index is built lazily on first use and afterwards kept current by the
+    receivers in widget.signals, which call the change methods below. Like
+    the catalog generation, an index only ever holds committed changes.
+
+    Changes made by other processes show up as a catalog generation the
+    index has not followed, or, when the processes do not share the cache, as
+    a change sequence that moved on (read at most every
+    WIDGET_CHANGE_CHECK_INTERVAL seconds). The index then reads the objects
+    changed since the last sequence number it read from the change log, see
+    `catch_up`, rather than rebuilding. It reads every change it can see
+    but only moves its sequence number up to the settled one, see
+    widget.changes.latest_seq, so changes that commit out of order are read
+    again rather than skipped.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+        register_follower(self)
+        catalog_indexes.append(self)
+
+    def reset(self):
+        with self.lock:
+            # catalog generation the index is current for
+            self.generation = None
+            # last change sequence number read, and when
+            self.seq = None
+            self.checked = 0.0
+            # whether changes were committed that the index was not given
+            self.behind = False
+            self.clear()
+
+    @property
+    def built(self):
+        return self.generation is not None
+
+    def ensure_built(self):
+        """
+        Builds the index, or catches it up with the changes it missed, unless
+        it is current. Called holding the lock.
+        """
+        current = generation()
+        now = time.time()
+        if not self.built:
+            self.seq = latest_seq()
+            self.checked = now
+            self.clear()
+            self.load()
+            self.generation = current
+        elif self.behind or self.generation != current or now - self.checked >= settings.WIDGET_CHANGE_CHECK_INTERVAL:
+            if uncommitted_changes():
+                # The transaction would read its own changes, which may
+                # still be rolled back
+                return
+            # Read before the changes, anything committed meanwhile is read
+            # again next time
+            seq = latest_seq()
+            self.checked = now
+            if seq < self.seq:
+                # The database was replaced
+                self.clear()
+                self.load()
+            elif seq > self.seq or self.behind or self.generation != current:
+                if self.seq < oldest_seq():
+                    # The changes since were compacted
+                    self.clear()
+                    self.load()
+                else:
+                    # A commit that moved the generation may not have settled
+                    # yet, so read every visible change after the last settled
+                    # number rather than only up to the settled one
+                    self.catch_up(self.seq)
+            self.seq = seq
+            self.behind = False
+            self.generation = current
+
+    def follow(self, new_generation, missed=False):
+        with self.lock:
+            if self.generation == new_generation - 1:
+                self.generation = new_generation
+            else:
+                missed = True
+            if missed and self.built:
+                self.behind = True
+
+    def fall_behind(self):
+        with self.lock:
+            if self.built:
+                self.behind = True
+
+    def clear(self):
+        raise NotImplementedError
+
+    def load(self):
+        raise NotImplementedError
+
+    def catch_up(self, since):
+        """
+        Applies the changes committed after sequence number `since`, see
+        widget.changes.changes_since. Indexes that cannot tell what to update
+        rebuild.
+        """
+        self.clear()
+        self.load()
+
+    def widget_saved(self, widget):
+        pass
+
+    def widgets_updated(self, widget_ids):
+        pass
+
+    def widget_deleted(self, widget_id):
+        pass
+
+    def features_added(self, feature_ids, widget_ids):
+        pass
+
+    def features_removed(self, feature_ids, widget_ids):
+        pass
+
+    def widget_features_cleared(self, widget_id):
+        pass
+
+    def feature_widgets_cleared(self, feature_id):
+        pass
+
+    def feature_saved(self, feature):
+        pass
+
+    def feature_deleted(self, feature_id):
+        pass
+
+    def category_saved(self, category):
+        pass
+
+
+# Substrings of feature labels up to this length are indexed
+GRAM_LENGTH = 3
+
+
+def label_grams(label):
+    """
+    Every substring of `label` up to GRAM_LENGTH characters long.
+    """
+    return set(
+        label[start:start + length]
+        for length in range(1, GRAM_LENGTH + 1)
+        for start in range(len(label) - length + 1)
+    )
+
+
+class FeatureIndex(CatalogIndex):
+    """
+    Inverted index from the substrings of feature labels to the features that
+    have them, so that a filter term is resolved to the few features whose
+    labels contain it without a LIKE join or a pass over every label. A term
+    up to GRAM_LENGTH characters is looked up directly, a longer one
+    intersects the features of each of its substrings of that length and
+    checks the few left. The widgets are then filtered on those features'
+    ids, with the index of the link table. A term matches every label that
+    contains it, ignoring case, the same as the icontains filter this
+    replaces.
+    """
+    def clear(self):
+        # feature id -> lowercased label
+        self.labels = {}
+        # label substring -> set of feature ids
+        self.grams = {}
+
+    def load(self):
+        for feature_id, label in Feature.objects.values_list("id", "label"):
+            self.add(feature_id, label)
+
+    def catch_up(self, since):
+        changed, deleted = changes_since(since)
+        for feature_id in deleted["feature"]:
+            self.remove(feature_id)
+        for feature_id, label in changed["feature"].values_list("id", "label"):
+            self.add(feature_id, label)
+
+    def add(self, feature_id, label):
+        self.remove(feature_id)
+        label = label.lower()
+        self.labels[feature_id] = label
+        for gram in label_grams(label):
+            self.grams.setdefault(gram, set()).add(feature_id)
+
+    def remove(self, feature_id):
+        label = self.labels.pop(feature_id, None)
+        if label is None:
+            return
+        for gram in label_grams(label):
+            feature_ids = self.grams[gram]
+            feature_ids.discard(feature_id)
+            if not feature_ids:
+                del self.grams[gram]
+
+    def matching(self, term):
+        if not term:
+            return set(self.labels)
+        if len(term) <= GRAM_LENGTH:
+            return set(self.grams.get(term, ()))
+        postings = sorted(
+            (self.grams.get(term[start:start + GRAM_LENGTH], set()) for start in range(len(term) - GRAM_LENGTH + 1)),
+            key=len,
+        )
+        candidates = postings[0].intersection(*postings[1:])
+        return set(feature_id for feature_id in candidates if term in self.labels[feature_id])
+
+    def feature_ids(self, terms):
+        """
+        The ids of the features matching each term, one set per term.
+        """
+        with self.lock:
+            self.ensure_built()
+            return [self.matching(term.lower()) for term in terms]
+
+    @incremental
+    def feature_saved(self, feature):
+        self.add(feature.pk, feature.label)
+
+    @incremental
+    def feature_deleted(self, feature_id):
+        self.remove(feature_id)
+
+
+feature_index = FeatureIndex()
@@ -0,0 +1,100 @@
+import json
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+from django.test import override_settings
+
+from widget.assets import ENCODINGS
+
+ASSET_URL = re.compile(r'(?:src|href)="([^"]+)"')
+CSS_URL = re.compile(r'url\(\s*[\'"]?([^\'")]+)[\'"]?\s*\)')
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports the static assets a browser transfers to load the store page, served as before "
+        "(uncompressed, under fixed names revalidated on every visit) and as widget.assets serves them now "
+        "(precompressed, under hashed names cached for good). Run collectstatic first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--previous",
+            help="staticfiles.json of the previous deploy, to also report a returning visitor's first load after this one.",
+        )
+
+    def handle(self, *args, **options):
+        if not getattr(staticfiles_storage, "hashed_names", None):
+            raise CommandError("No collected static files in %s, run collectstatic first." % settings.STATIC_ROOT)
+
+        rows = []
+        for name in self.page_assets():
+            sizes = {"identity": self.size(name)}
+            for encoding, suffix in ENCODINGS:
+                sizes[encoding] = self.size(name + suffix)
+            rows.append((name, sizes, name in staticfiles_storage.hashed_names))
+
+        self.stdout.write("%-56s %10s %10s %10s  %s" % ("asset", "identity", "gzip", "br", "cache"))
+        for name, sizes, hashed in rows:
+            self.stdout.write("%-56s %10s %10s %10s  %s" % (
+                name, sizes["identity"], sizes["gzip"] or "-", sizes["br"] or "-", "immutable" if hashed else "no-cache",
+            ))
+
+        identity = dict((name, sizes["identity"]) for name, sizes, hashed in rows)
+        smallest = dict((name, min(size for size in sizes.values() if size)) for name, sizes, hashed in rows)
+        # A revalidated file that has not changed costs a request, answered by
+        # a 304 without a body. Cached hashed files cost nothing.
+        revalidated = [name for name, sizes, hashed in rows if not hashed]
+        self.stdout.write("\n%-28s %20s %20s" % ("per page load", "before", "after"))
+        self.line("first visit", sum(identity.values()), len(rows), sum(smallest.values()), len(rows))
+        self.line("repeat visit", 0, len(rows), 0, len(revalidated))
+        if options["previous"]:
+            with open(options["previous"]) as manifest:
+                previous = set(json.load(manifest)["paths"].values())
+            changed = [name for name in smallest if name not in previous]
+            # Before, every deploy changed the single bundle with all of the
+            # scripts, styles and fonts in it
+            self.line(
+                "repeat visit after deploy", sum(identity.values()), len(rows),
+                sum(smallest[name] for name in changed), len(changed) + len(revalidated),
+            )
+
+    def line(self, label, before_bytes, before_requests, after_bytes, after_requests):
+        self.stdout.write("%-28s %10d bytes %3d req %10d bytes %3d req" % (
+            label, before_bytes, before_requests, after_bytes, after_requests,
+        ))
+
+    def page_assets(self):
+        """
+        The collected names of the static files the store page loads: its
+        scripts and stylesheets and the fonts these use, counted in the woff2
+        format browsers pick.
+        """
+        # Hashed names are only used with DEBUG off
+        with override_settings(DEBUG=False):
+            html = render_to_string("widget/index.html", {"categories": []})
+        names = []
+        for url in ASSET_URL.findall(html):
+            if not url.startswith(settings.STATIC_URL):
+                continue
+            name = url[len(settings.STATIC_URL):]
+            names.append(name)
+            if name.endswith(".css"):
+                with staticfiles_storage.open(name) as css:
+                    content = css.read().decode("utf-8")
+                for font in CSS_URL.findall(content):
+                    font = re.split(r"[?#]", font)[0]
+                    if font.endswith(".woff2"):
+                        font = posixpath.normpath(posixpath.join(posixpath.dirname(name), font))
+                        if font not in names:
+                            names.append(font)
+        return names
+
+    def size(self, name):
+        path = staticfiles_storage.path(name)
+        return os.path.getsize(path) if os.path.exists(path) else None
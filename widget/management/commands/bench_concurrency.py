@@ -0,0 +1,161 @@
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils.six.moves import http_client
+from django.utils.six.moves.urllib.parse import urlparse
+
+from widget.benchmark import PooledWSGIServer, format_summary, generate_catalog, summarize
+from widget.models import Widget, Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves the WSGI application over HTTP on a fixed pool of worker threads and measures "
+        "throughput and latency of the catalog and order reads with many concurrent clients, "
+        "optionally while slow clients hold connections open. With --url the catalog reads of "
+        "a running server, such as one behind a buffering front end, are measured instead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--widgets", type=int, default=1000)
+        parser.add_argument("--threads", type=int, default=8, help="Worker threads serving requests.")
+        parser.add_argument(
+            "--concurrency", default="1,8,32", help="Comma separated numbers of concurrent clients to run with."
+        )
+        parser.add_argument("--requests", type=int, default=20, help="Requests per client.")
+        parser.add_argument("--slow-clients", type=int, default=0, help="Connections that never finish their request.")
+        parser.add_argument("--timeout", type=float, default=10.0, help="Seconds before a client gives up.")
+        parser.add_argument("--url", help="Base URL of a running server to measure, e.g. http://localhost:8000.")
+
+    def handle(self, *args, **options):
+        if options["url"]:
+            parsed = urlparse(options["url"])
+            address = (parsed.hostname, parsed.port or 80)
+            widgets = self.fetch(address, "/widget/?page_size=100", options["timeout"])
+            if isinstance(widgets, dict):
+                widgets = widgets["results"]
+            if not widgets:
+                raise CommandError("%s lists no widgets to read." % options["url"])
+            widget_ids = [widget["id"] for widget in widgets]
+            # The orders of another database are not known, only the catalog is read
+            self.measure_routes(address, [
+                ("widget list page", lambda: "/widget/?page_size=50"),
+                ("widget detail", lambda: "/widget/%s/" % random.choice(widget_ids)),
+            ], options, "server at %s" % options["url"])
+            return
+
+        setup_test_environment()
+        old_name = connection.settings_dict["NAME"]
+        directory = None
+        if connection.vendor == "sqlite":
+            # An in-memory test database is private to the thread that made it
+            directory = tempfile.mkdtemp()
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "bench.sqlite3")
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(ALLOWED_HOSTS=["*"]):
+                generate_catalog(10, 20, options["widgets"], 3)
+                self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            if directory:
+                shutil.rmtree(directory)
+
+    def run(self, options):
+        widget_ids = list(Widget.objects.values_list("id", flat=True))
+        order_numbers = []
+        for _ in range(20):
+            order = Order.objects.create()
+            OrderItem.objects.create(order=order, widget_id=random.choice(widget_ids), quantity=1)
+            order_numbers.append(order.number)
+        routes = [
+            ("widget list page", lambda: "/widget/?page_size=50"),
+            ("widget detail", lambda: "/widget/%s/" % random.choice(widget_ids)),
+            ("order detail", lambda: "/order/%s" % random.choice(order_numbers)),
+        ]
+
+        server = PooledWSGIServer(("127.0.0.1", 0), get_wsgi_application(), options["threads"])
+        serving = threading.Thread(target=server.serve_forever)
+        serving.daemon = True
+        serving.start()
+        try:
+            self.measure_routes(server.server_address, routes, options, "worker threads: %s" % options["threads"])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def measure_routes(self, address, routes, options, description):
+        slow = [self.slow_client(address) for _ in range(options["slow_clients"])]
+        try:
+            self.stdout.write("%s, slow clients: %s" % (description, len(slow)))
+            for clients in [int(value) for value in options["concurrency"].split(",")]:
+                for name, path in routes:
+                    summary, failed = self.measure(address, path, clients, options["requests"], options["timeout"])
+                    line = "%-18s %4s clients  " % (name, clients)
+                    if summary["count"]:
+                        line += format_summary(summary)
+                    self.stdout.write("%s  %s failed" % (line, failed))
+        finally:
+            for sock in slow:
+                sock.close()
+
+    def fetch(self, address, path, timeout):
+        try:
+            http = http_client.HTTPConnection(address[0], address[1], timeout=timeout)
+            http.request("GET", path, headers={"Accept": "application/json"})
+            response = http.getresponse()
+            content = response.read()
+            http.close()
+            if response.status != 200:
+                raise ValueError("status %s" % response.status)
+            return json.loads(content.decode("utf-8"))
+        except (socket.error, http_client.HTTPException, ValueError) as error:
+            raise CommandError("Could not read %s: %s" % (path, error))
+
+    def slow_client(self, address):
+        """
+        A connection that sends part of a request and then stalls, like a
+        client on a bad mobile link.
+        """
+        sock = socket.create_connection(address)
+        sock.sendall(b"GET /widget/ HTTP/1.1\r\nHost: localhost\r\n")
+        return sock
+
+    def measure(self, address, path, clients, requests, timeout):
+        latencies = []
+        failures = []
+
+        def client():
+            for _ in range(requests):
+                start = time.time()
+                try:
+                    http = http_client.HTTPConnection(address[0], address[1], timeout=timeout)
+                    http.request("GET", path())
+                    response = http.getresponse()
+                    response.read()
+                    http.close()
+                    if response.status != 200:
+                        raise ValueError("status %s" % response.status)
+                    latencies.append(time.time() - start)
+                except (socket.error, http_client.HTTPException, ValueError) as error:
+                    failures.append(error)
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(latencies, time.time() - start), len(failures)
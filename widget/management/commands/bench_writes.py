@@ -0,0 +1,117 @@
+import threading
+import time
+import uuid
+
+from django.db import connection, transaction, OperationalError
+from django.core.management.base import BaseCommand
+
+from widget.benchmark import format_summary, summarize
+from widget.checkout import enqueue_checkout, process_jobs
+from widget.models import Category, Widget, Order, OrderItem
+from widget.stock import reserve_stock
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs concurrent checkouts against the configured database and reports write throughput. "
+        "The rows it creates are removed again afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--checkouts", type=int, default=100, help="Checkouts per thread.")
+        parser.add_argument(
+            "--queue", action="store_true",
+            help="Only queue the checkouts, as with WIDGET_CHECKOUT_QUEUE, while a worker thread completes them.",
+        )
+        parser.add_argument("--batch-size", type=int, default=100, help="Jobs per worker batch with --queue.")
+
+    def handle(self, *args, **options):
+        prefix = "bench-writes-%s" % uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=prefix, label="Write benchmark")
+        # Every checkout takes from the shared widget and from its thread's own widget
+        hot = Widget.objects.create(category=category, name=prefix, description="", price="1.00", quantity=10 ** 9)
+        widgets = [
+            Widget.objects.create(category=category, name="%s-%s" % (prefix, i), description="", price="1.00", quantity=10 ** 9)
+            for i in range(options["threads"])
+        ]
+
+        latencies = []
+        errors = []
+        order_ids = []
+
+        def checkout(widget):
+            try:
+                for _ in range(options["checkouts"]):
+                    start = time.time()
+                    try:
+                        with transaction.atomic():
+                            order = Order.objects.create()
+                            OrderItem.objects.bulk_create([
+                                OrderItem(order=order, widget=hot, quantity=1),
+                                OrderItem(order=order, widget=widget, quantity=1),
+                            ])
+                            if options["queue"]:
+                                enqueue_checkout(order)
+                            else:
+                                reserve_stock({hot.id: 1, widget.id: 1})
+                                Order.objects.filter(id=order.id).update(completed=True)
+                        order_ids.append(order.id)
+                        latencies.append(time.time() - start)
+                    except OperationalError as error:
+                        errors.append(str(error))
+            finally:
+                connection.close()
+
+        checkouts_done = threading.Event()
+
+        def work():
+            try:
+                while True:
+                    try:
+                        processed = process_jobs(options["batch_size"])
+                    except OperationalError as error:
+                        errors.append(str(error))
+                        continue
+                    if not processed:
+                        if checkouts_done.is_set():
+                            break
+                        time.sleep(0.01)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(widget,)) for widget in widgets]
+        worker = threading.Thread(target=work)
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        if options["queue"]:
+            worker.start()
+        for thread in threads:
+            thread.join()
+        queued = time.time() - start
+        if options["queue"]:
+            checkouts_done.set()
+            worker.join()
+        elapsed = time.time() - start
+
+        self.stdout.write("database: %s %s" % (connection.vendor, connection.settings_dict["NAME"]))
+        if connection.vendor == "sqlite":
+            cursor = connection.cursor()
+            cursor.execute("PRAGMA journal_mode")
+            self.stdout.write("journal mode: %s" % cursor.fetchone()[0])
+        self.stdout.write("threads: %s" % options["threads"])
+        if latencies and options["queue"]:
+            # Clients wait for the enqueue only, throughput counts until the worker is done
+            self.stdout.write("enqueued: %s" % format_summary(summarize(latencies, queued)))
+            completed = Order.objects.filter(id__in=order_ids, completed=True).count()
+            self.stdout.write("completed: %s in %.2fs, %.1f/s" % (completed, elapsed, completed / elapsed))
+        elif latencies:
+            self.stdout.write("checkouts: %s" % format_summary(summarize(latencies, elapsed)))
+        self.stdout.write("failed: %s" % len(errors))
+        for error in sorted(set(errors)):
+            self.stdout.write("  %s" % error)
+
+        Order.objects.filter(id__in=order_ids).delete()
+        Widget.objects.filter(category=category).delete()
+        category.delete()
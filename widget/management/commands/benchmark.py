@@ -0,0 +1,227 @@
+import itertools
+import json
+import random
+import subprocess
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+
+from widget.benchmark import Scenario, compare, format_summary, generate_catalog, measure_renderers, run_scenario
+from widget.changes import latest_seq
+from widget.models import Category, Feature, Widget, Order, OrderItem
+from widget.renderers import CATALOG_RENDERERS, MessagePackRenderer, msgpack
+from widget.search import tokenize
+from widget.serializers import WidgetSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks every REST endpoint in-process against a generated catalog in a throwaway "
+        "test database and reports latency percentiles, throughput and SQL queries per request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", type=int, default=10)
+        parser.add_argument("--features", type=int, default=20, help="Features per category.")
+        parser.add_argument("--widgets", type=int, default=1000)
+        parser.add_argument("--density", type=int, default=3, help="Features per widget.")
+        parser.add_argument("--requests", type=int, default=100, help="Timed requests per endpoint.")
+        parser.add_argument("--warmup", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--only", action="append", help="Only run endpoints whose name contains this.")
+        parser.add_argument("--cache", action="store_true", help="Serve catalog reads from the response cache.")
+        parser.add_argument(
+            "--no-snapshot", action="store_false", dest="snapshot", help="Serialize catalog reads instead of using the snapshot."
+        )
+        parser.add_argument(
+            "--formats", action="store_true", help="Also report the size and encode time of the listing in every format."
+        )
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--compare", help="Compare against results saved with --output.")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            settings = {"WIDGET_CACHE_RESPONSES": options["cache"], "WIDGET_CATALOG_SNAPSHOT": options["snapshot"]}
+            with override_settings(**settings):
+                start = time.time()
+                generate_catalog(
+                    options["categories"], options["features"], options["widgets"], options["density"], options["seed"]
+                )
+                self.stdout.write("generated %s widgets in %.1fs" % (options["widgets"], time.time() - start))
+                results = self.run(options)
+                if options["formats"]:
+                    self.formats()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options["output"]:
+            report = {"commit": self.commit(), "options": self.catalog_options(options), "results": results}
+            with open(options["output"], "w") as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+
+        if options["compare"]:
+            with open(options["compare"]) as baseline_file:
+                baseline = json.load(baseline_file)
+            if baseline["options"] != self.catalog_options(options):
+                self.stderr.write("warning: baseline was run with different options %s" % baseline["options"])
+            self.stdout.write("\ncompared to %s" % (baseline.get("commit") or options["compare"]))
+            for name, metric, before, after, change in compare(baseline["results"], results):
+                self.stdout.write("%-24s %-10s %10.2f %10.2f %+7.1f%%" % (name, metric, before, after, change))
+
+    def run(self, options):
+        client = Client()
+        results = {}
+        for scenario in self.scenarios(options["seed"]):
+            if options["only"] and not any(only in scenario.name for only in options["only"]):
+                continue
+            summary = run_scenario(client, scenario, options["requests"], options["warmup"])
+            results[scenario.name] = summary
+            self.stdout.write("%-24s %s  %5.1f queries" % (scenario.name, format_summary(summary), summary["queries"]))
+        return results
+
+    def formats(self):
+        widgets = Widget.objects.select_related("category").prefetch_related("features").order_by("category_name", "id")
+        data = WidgetSerializer(widgets, many=True).data
+        renderers = [JSONRenderer()] + [renderer() for renderer in CATALOG_RENDERERS if renderer is not BrowsableAPIRenderer]
+        self.stdout.write("\nwidget listing, %s widgets" % len(data))
+        # DRF's JSONRenderer and FastJSONRenderer share the json format
+        for name, renderer in zip(["json (DRF)"] + [renderer.format for renderer in renderers[1:]], renderers):
+            result = measure_renderers(data, [renderer])[renderer.format]
+            self.stdout.write("%-24s %10d bytes  %8.2fms" % (name, result["bytes"], result["encode_ms"]))
+
+    def scenarios(self, seed):
+        rng = random.Random(seed)
+        widget_ids = list(Widget.objects.values_list("id", flat=True))
+        category_ids = list(Category.objects.values_list("id", flat=True))
+        labels = list(Feature.objects.values_list("label", flat=True))
+        terms = [term for label in labels for term in tokenize(label)]
+        counter = itertools.count()
+
+        def new_order(lines=5):
+            order = Order.objects.create()
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, widget_id=widget_id, quantity=1)
+                for widget_id in rng.sample(widget_ids, lines)
+            ])
+            return order
+
+        def widget_data(widget):
+            return {
+                "name": "benchmark-%s" % next(counter),
+                "description": "Benchmark widget",
+                "price": "9.99",
+                "category": widget.category_id,
+                "features": list(widget.features.values_list("id", flat=True)),
+            }
+
+        def filter_on_client(client, _):
+            # What clients did before the price and stock filters: fetch the
+            # whole catalog and filter and sort it themselves
+            response = client.get("/widget/")
+            widgets = [
+                widget for widget in json.loads(response.content)
+                if 50 <= Decimal(widget["price"]) <= 100 and widget["quantity"] != 0
+            ]
+            widgets.sort(key=lambda widget: (Decimal(widget["price"]), widget["id"]))
+            return response
+
+        def random_widget():
+            return Widget.objects.get(id=rng.choice(widget_ids))
+
+        def random_item():
+            return rng.choice(new_order().orderitem_set.all())
+
+        scenarios = [
+            Scenario("ui", lambda client, _: client.get("/")),
+            Scenario("widget list", lambda client, _: client.get("/widget/")),
+            Scenario("widget list page", lambda client, _: client.get("/widget/", {"page_size": 50})),
+            Scenario("widget list category", lambda client, _: client.get("/widget/", {"category": rng.choice(category_ids)})),
+            Scenario("widget list features", lambda client, _: client.get("/widget/", {"features": rng.sample(labels, 2)})),
+            Scenario(
+                "widget list facets",
+                lambda client, _: client.get("/widget/", {"facets": 1, "page_size": 50, "category": rng.choice(category_ids)}),
+            ),
+            Scenario(
+                "widget list price range",
+                lambda client, _: client.get(
+                    "/widget/", {"min_price": 50, "max_price": 100, "in_stock": 1, "sort": "price", "page_size": 50}
+                ),
+            ),
+            Scenario("widget list client side", filter_on_client),
+            Scenario("widget list csv", lambda client, _: client.get("/widget/", HTTP_ACCEPT="text/csv")),
+            Scenario("widget search", lambda client, _: client.get("/widget/search/", {"q": rng.choice(terms)})),
+            Scenario("widget search prefix", lambda client, _: client.get("/widget/search/", {"q": rng.choice(terms)[:3]})),
+            Scenario(
+                "widget changes",
+                lambda client, since: client.get("/widget/changes/", {"since": since}),
+                prepare=lambda: max(latest_seq() - 20, 0),
+            ),
+            Scenario("widget export", lambda client, _: client.get("/widget/export/")),
+            Scenario("widget export ndjson", lambda client, _: client.get("/widget/export/", {"ndjson": 1})),
+            Scenario("widget detail", lambda client, _: client.get("/widget/%s/" % rng.choice(widget_ids))),
+            Scenario(
+                "widget create",
+                lambda client, data: client.post("/widget/", json.dumps(data), content_type="application/json"),
+                prepare=lambda: widget_data(random_widget()),
+                expected_status=201,
+            ),
+            Scenario(
+                "widget update",
+                lambda client, widget: client.put(
+                    "/widget/%s" % widget.id, json.dumps(widget_data(widget)), content_type="application/json"
+                ),
+                prepare=random_widget,
+            ),
+            Scenario(
+                "order create",
+                lambda client, lines: client.post("/order/", json.dumps({"items": lines}), content_type="application/json"),
+                prepare=lambda: [{"widget": widget_id, "quantity": 1} for widget_id in rng.sample(widget_ids, 5)],
+                expected_status=201,
+            ),
+            Scenario("order detail", lambda client, order: client.get("/order/%s" % order.number), prepare=new_order),
+            Scenario("order complete", lambda client, order: client.post("/order/%s/complete/" % order.number), prepare=new_order),
+            Scenario("order delete", lambda client, order: client.delete("/order/%s/" % order.number), prepare=new_order),
+            Scenario(
+                "order item create",
+                lambda client, order: client.post(
+                    "/order/item/", {"order": order.id, "widget": rng.choice(widget_ids), "quantity": 1}
+                ),
+                prepare=lambda: new_order(lines=0),
+                expected_status=201,
+            ),
+            Scenario("order item detail", lambda client, item: client.get("/order/item/%s" % item.id), prepare=random_item),
+            Scenario(
+                "order item update",
+                lambda client, item: client.put(
+                    "/order/item/%s" % item.id,
+                    json.dumps({"order": item.order_id, "widget": item.widget_id, "quantity": 2}),
+                    content_type="application/json",
+                ),
+                prepare=random_item,
+            ),
+            Scenario("order item delete", lambda client, item: client.delete("/order/item/%s" % item.id), prepare=random_item),
+        ]
+        if msgpack is not None:
+            scenarios.append(Scenario(
+                "widget list msgpack", lambda client, _: client.get("/widget/", HTTP_ACCEPT=MessagePackRenderer.media_type)
+            ))
+        return scenarios
+
+    def catalog_options(self, options):
+        names = ("categories", "features", "widgets", "density", "requests", "seed", "cache", "snapshot")
+        return dict((name, options[name]) for name in names)
+
+    def commit(self):
+        try:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,62 @@
+import json
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.six.moves.urllib.error import URLError
+from django.utils.six.moves.urllib.request import urlopen
+
+from widget import cache
+from widget.snapshot import catalog_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Shows the catalog response cache counters of a serving process, optionally invalidating the cache "
+        "of every process, and the memory a catalog snapshot of the current database takes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url", help="Base URL of a serving process to read the counters from, e.g. http://localhost:8000."
+        )
+        parser.add_argument(
+            "--invalidate", action="store_true",
+            help="Log a catalog change, which drops the cached responses of every process.",
+        )
+        parser.add_argument("--snapshot", action="store_true", help="Build the catalog snapshot and report its size.")
+
+    def handle(self, *args, **options):
+        if options["invalidate"]:
+            cache.invalidate()
+            self.stdout.write("invalidated")
+
+        if options["url"]:
+            stats = self.fetch_stats(options["url"])
+        elif isinstance(cache.get_cache(), LocMemCache):
+            # The counters are kept in the cache of each serving process
+            stats = None
+            self.stdout.write("The cache is local to each process, pass --url to read the counters of one.")
+        else:
+            stats = cache.stats()
+        if stats is not None:
+            lookups = stats["hits"] + stats["misses"]
+            self.stdout.write("generation: %s" % stats["generation"])
+            self.stdout.write("hits: %s" % stats["hits"])
+            self.stdout.write("misses: %s" % stats["misses"])
+            if lookups:
+                self.stdout.write("hit rate: %.1f%%" % (100.0 * stats["hits"] / lookups))
+
+        if options["snapshot"]:
+            memory = catalog_snapshot.memory()
+            self.stdout.write("snapshot widgets: %s" % memory["widgets"])
+            self.stdout.write("snapshot json: %s bytes" % memory["json_bytes"])
+            self.stdout.write("snapshot entries: %s bytes" % memory["entry_bytes"])
+            self.stdout.write("snapshot index: %s bytes" % memory["index_bytes"])
+            self.stdout.write("snapshot per widget: %.0f bytes" % memory["bytes_per_widget"])
+
+    def fetch_stats(self, url):
+        try:
+            response = urlopen(url.rstrip("/") + "/widget/cache/?format=json")
+            return json.loads(response.read().decode("utf-8"))
+        except (URLError, ValueError) as error:
+            raise CommandError("Could not read the counters from %s: %s" % (url, error))
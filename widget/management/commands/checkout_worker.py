@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from widget.checkout import process_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Completes queued checkouts in batches, see WIDGET_CHECKOUT_QUEUE. Runs until interrupted, "
+        "or with --once until the queue is empty."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--interval", type=float, default=0.2, help="Seconds to wait when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            count = process_jobs(options["batch_size"])
+            processed += count
+            if count:
+                continue
+            if options["once"]:
+                break
+            # Gives the connection back between polls, like a finished request
+            connection.close_if_unusable_or_obsolete()
+            time.sleep(options["interval"])
+        self.stdout.write("%s jobs processed" % processed)
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from widget.changes import compact_changes
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes catalog changes older than the retention window from the change log. Mirrors "
+        "whose last sequence number is older have to fetch the whole catalog again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=settings.WIDGET_CHANGE_RETENTION_DAYS,
+            help="Keep the changes of this many days.",
+        )
+
+    def handle(self, *args, **options):
+        deleted = compact_changes(options["days"])
+        self.stdout.write("deleted %s changes" % deleted)
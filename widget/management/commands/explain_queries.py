@@ -0,0 +1,102 @@
+import random
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.migrations.recorder import MigrationRecorder
+from django.http import QueryDict
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from widget.benchmark import explain, generate_catalog, time_query
+from widget.models import Category, Widget, Order, OrderItem
+from widget.views import WIDGET_ORDERING, filter_widgets
+
+# The first migration with the columns the listing orders by
+LISTING_MIGRATION = ("widget", "0008_widget_category_name")
+
+
+class Command(BaseCommand):
+    help = (
+        "Prints query plans and timings for the catalog and order queries against a generated "
+        "catalog, before and after the index migrations, in a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--widgets", type=int, default=20000)
+        parser.add_argument("--orders", type=int, default=5000)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--before", default="0001", help="Migration to compare against.")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            generate_catalog(50, 20, options["widgets"], 3)
+            self.generate_orders(options["orders"])
+            after = self.measure(options["repeat"])
+            call_command("migrate", "widget", options["before"], verbosity=0)
+            before = self.measure(options["repeat"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, (plan_after, time_after) in after:
+            plan_before, time_before = dict(before)[name]
+            self.stdout.write("%s: %.2fms -> %.2fms" % (name, time_before, time_after))
+            self.stdout.write("  before (%s):" % options["before"])
+            for line in plan_before:
+                self.stdout.write("    %s" % line)
+            self.stdout.write("  after:")
+            for line in plan_after:
+                self.stdout.write("    %s" % line)
+
+    def generate_orders(self, count):
+        rng = random.Random(0)
+        widget_ids = list(Widget.objects.values_list("id", flat=True))
+        Order.objects.bulk_create([Order(number="%010x" % n, completed=rng.random() < 0.8) for n in range(count)])
+        OrderItem.objects.bulk_create([
+            OrderItem(order_id=order_id, widget_id=widget_id, quantity=1)
+            for order_id in Order.objects.values_list("id", flat=True)
+            for widget_id in rng.sample(widget_ids, 3)
+        ], batch_size=500)
+
+    def listing(self, params, page_size=50):
+        """
+        The first page of the widget listing for the query string `params`,
+        as the view fetches it. Against a schema older than
+        LISTING_MIGRATION, which the model's columns are not in yet, the
+        listing as it was then, ordered by the joined category name.
+        """
+        if LISTING_MIGRATION in MigrationRecorder(connection).applied_migrations():
+            widgets = filter_widgets(QueryDict(params)).select_related("category")
+            # One more than the page, to tell whether another follows
+            return widgets.order_by(*WIDGET_ORDERING)[:page_size + 1]
+        # Only columns from the initial migration are selected
+        widgets = Widget.objects.all()
+        if params:
+            widgets = widgets.filter(category_id=QueryDict(params)["category"])
+        columns = ("id", "name", "price", "quantity", "category__name")
+        return widgets.order_by("category__name", "id").values(*columns)[:page_size]
+
+    def queries(self):
+        # Only columns from the initial migration are selected, so the same
+        # querysets run against the schema before the index migrations. The
+        # listings follow the schema, see `listing`.
+        category_ids = Category.objects.order_by("id").values_list("id", flat=True)
+        category_id = category_ids[len(category_ids) // 2]
+        order_id, number = Order.objects.filter(completed=False).order_by("id").values_list("id", "number").last()
+        widget_id = OrderItem.objects.filter(order_id=order_id).order_by("id").values_list("widget_id", flat=True).first()
+        return [
+            ("widget listing", self.listing("")),
+            ("widget listing by category", self.listing("category=%s" % category_id)),
+            ("open order by number", Order.objects.filter(number=number, completed=False).values("id")),
+            ("order items", OrderItem.objects.filter(order_id=order_id).values("id", "widget_id", "quantity")),
+            ("order item by widget", OrderItem.objects.filter(order_id=order_id, widget_id=widget_id).values("id")),
+        ]
+
+    def measure(self, repeat):
+        # Give the planner statistics, as a maintained database would have
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        return [(name, (explain(queryset), time_query(queryset, repeat))) for name, queryset in self.queries()]
@@ -0,0 +1,43 @@
+import json
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from widget.imports import READERS, WidgetImporter
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports widgets from a CSV or NDJSON file, creating new widgets and updating existing ones "
+        "matched by name, and reports the rows per second and every row that failed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import, - for standard input.")
+        parser.add_argument("--format", choices=sorted(READERS), help="Defaults to the file's extension.")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if format not in READERS:
+            raise CommandError("Unknown format, pass --format %s." % " or --format ".join(sorted(READERS)))
+
+        stream = sys.stdin if path == "-" else open(path, "rb")
+        try:
+            result = WidgetImporter(options["batch_size"]).run(READERS[format](stream))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for error in result.errors:
+            self.stderr.write("line %s: %s" % (error["line"], json.dumps(error["errors"], sort_keys=True)))
+        if result.error_count > len(result.errors):
+            self.stderr.write("... and %s more errors" % (result.error_count - len(result.errors)))
+        self.stdout.write(
+            "%s rows in %.1fs (%.0f rows/s): %s created, %s updated, %s failed" % (
+                result.rows, result.seconds, result.rows_per_second or 0,
+                result.created, result.updated, result.error_count,
+            )
+        )
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2026-10-18 20:19
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_items(apps, schema_editor):
+    """
+    Folds order items for the same widget into the first one so the unique
+    constraint can be added.
+    """
+    OrderItem = apps.get_model('widget', 'OrderItem')
+    duplicates = OrderItem.objects.values('order', 'widget').annotate(lines=Count('id')).filter(lines__gt=1)
+    for duplicate in duplicates:
+        items = list(OrderItem.objects.filter(order=duplicate['order'], widget=duplicate['widget']).order_by('id'))
+        items[0].quantity = sum(item.quantity for item in items)
+        items[0].save()
+        OrderItem.objects.filter(id__in=[item.id for item in items[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('widget', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='category',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='orderitem',
+            unique_together=set([('order', 'widget')]),
+        ),
+        migrations.AddIndex(
+            model_name='widget',
+            index=models.Index(fields=[b'category', b'id'], name=b'widget_category_id_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2026-10-18 20:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('widget', '0002_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[(b'category', b'category'), (b'feature', b'feature'), (b'widget', b'widget')], max_length=10)),
+                ('object_id', models.IntegerField(blank=True, null=True)),
+                ('deleted', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='change_seq',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='feature',
+            name='change_seq',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='widget',
+            name='change_seq',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+    ]
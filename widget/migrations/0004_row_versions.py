@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2026-10-18 20:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('widget', '0003_change_tracking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='widget',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
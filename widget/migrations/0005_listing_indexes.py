@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2026-10-18 20:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('widget', '0004_row_versions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='widget',
+            index=models.Index(fields=[b'price', b'id'], name=b'widget_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='widget',
+            index=models.Index(fields=[b'quantity'], name=b'widget_quantity_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2026-10-18 20:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('widget', '0005_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckoutJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[(b'pending', b'pending'), (b'done', b'done'), (b'failed', b'failed')], default=b'pending', max_length=10)),
+                ('errors', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='widget.Order')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='checkoutjob',
+            index=models.Index(fields=[b'status', b'id'], name=b'checkoutjob_status_id_idx'),
+        ),
+    ]
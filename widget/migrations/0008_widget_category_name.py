@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2026-10-19 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def copy_category_names(apps, schema_editor):
+    Category = apps.get_model("widget", "Category")
+    Widget = apps.get_model("widget", "Widget")
+    for category_id, name in Category.objects.values_list("id", "name"):
+        Widget.objects.filter(category_id=category_id).update(category_name=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('widget', '0007_change_recorded'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='widget',
+            name='category_name',
+            field=models.CharField(default='', editable=False, max_length=100),
+        ),
+        migrations.RunPython(copy_category_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='widget',
+            index=models.Index(fields=[b'category_name', b'id'], name=b'widget_category_name_id_idx'),
+        ),
+    ]
@@ -5,6 +5,8 @@ from django.db import models
 from django.contrib import admin
 from django.core.validators import MinValueValidator
 
+from widget.versioning import VersionCheckedForm
+
 
 class FullDisplayModelMixin(object):
     def stringify_field(self, field):
@@ -18,23 +20,84 @@ class FullDisplayModelMixin(object):
         )
 
 
-class Category(FullDisplayModelMixin, models.Model):
-    name = models.CharField(max_length=100)
+class StampedFieldsMixin(object):
+    """
+    Saves with update_fields also write the `stamped_fields`, which
+    widget.signals sets before every save.
+    """
+    stamped_fields = ()
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = set(update_fields).union(self.stamped_fields)
+        super(StampedFieldsMixin, self).save(*args, **kwargs)
+
+
+class CatalogChange(models.Model):
+    """
+    Log of catalog changes, the id of a change is its sequence number. Every
+    category, feature and widget carries the sequence number of the last
+    change to it in `change_seq`, and deletes stay here as tombstones.
+    `object_id` is None for a change to several widgets at once, such as a
+    stock reservation. `recorded` is the database time the change was
+    written, see widget.changes.
+    """
+    kind = models.CharField(max_length=10, choices=[(kind, kind) for kind in ("category", "feature", "widget")])
+    object_id = models.IntegerField(blank=True, null=True)
+    deleted = models.BooleanField(default=False)
+    recorded = models.DateTimeField()
+
+
+class Category(StampedFieldsMixin, FullDisplayModelMixin, models.Model):
+    # Indexed because the catalog is listed in category name order
+    name = models.CharField(max_length=100, db_index=True)
     label = models.CharField(max_length=100)
+    change_seq = models.BigIntegerField(default=0, db_index=True, editable=False)
+    stamped_fields = ("change_seq",)
 
 
-class Feature(FullDisplayModelMixin, models.Model):
+class Feature(StampedFieldsMixin, FullDisplayModelMixin, models.Model):
     label = models.CharField(max_length=100)
     category = models.ForeignKey(Category)
+    change_seq = models.BigIntegerField(default=0, db_index=True, editable=False)
+    stamped_fields = ("change_seq",)
 
 
-class Widget(FullDisplayModelMixin, models.Model):
+class Widget(StampedFieldsMixin, FullDisplayModelMixin, models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.CharField(max_length=1000)
     category = models.ForeignKey(Category)
+    # Copy of the category's name, which the listing is ordered by, so that
+    # the order is served from an index of this table
+    category_name = models.CharField(max_length=100, default="", editable=False)
     price = models.DecimalField(decimal_places=2, max_digits=12, validators=[MinValueValidator(Decimal('0.01'))])
     features = models.ManyToManyField(Feature, verbose_name="Features for this widget")
     quantity = models.PositiveIntegerField(blank=True, null=True)
+    change_seq = models.BigIntegerField(default=0, db_index=True, editable=False)
+    # Incremented by every write to the row, see widget.versioning
+    version = models.PositiveIntegerField(default=1, editable=False)
+    stamped_fields = ("change_seq", "version")
+
+    class Meta:
+        indexes = [
+            # The listing order
+            models.Index(fields=["category_name", "id"], name="widget_category_name_id_idx"),
+            # Listing one category pages through its widgets in id order
+            models.Index(fields=["category", "id"], name="widget_category_id_idx"),
+            # Price ranges and the price sorts
+            models.Index(fields=["price", "id"], name="widget_price_id_idx"),
+            # in_stock is quantity IS NULL OR quantity > 0
+            models.Index(fields=["quantity"], name="widget_quantity_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "category" in update_fields:
+            self.category_name = self.category.name
+            if update_fields is not None:
+                kwargs["update_fields"] = list(update_fields) + ["category_name"]
+        super(Widget, self).save(*args, **kwargs)
 
 
 def generate_order_number():
@@ -47,10 +110,39 @@ class Order(FullDisplayModelMixin, models.Model):
     completed = models.BooleanField(default=False)
 
 
-class OrderItem(FullDisplayModelMixin, models.Model):
+class OrderItem(StampedFieldsMixin, FullDisplayModelMixin, models.Model):
     quantity = models.PositiveIntegerField()
     widget = models.ForeignKey(Widget)
     order = models.ForeignKey(Order)
+    version = models.PositiveIntegerField(default=1, editable=False)
+    stamped_fields = ("version",)
+
+    class Meta:
+        # An order has one line per widget, and its items are found by order
+        unique_together = ("order", "widget")
+
+
+class CheckoutJob(models.Model):
+    """
+    An order queued for completion by the checkout worker, see
+    widget/checkout.py. `errors` holds the JSON a synchronous checkout would
+    have answered with when the job failed.
+    """
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    order = models.OneToOneField(Order)
+    status = models.CharField(max_length=10, choices=[(status, status) for status in (PENDING, DONE, FAILED)], default=PENDING)
+    errors = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # The worker takes pending jobs oldest first
+            models.Index(fields=["status", "id"], name="checkoutjob_status_id_idx"),
+        ]
 
 
 class FeatureInline(admin.TabularInline):
@@ -71,6 +163,8 @@ class OrderItemInline(admin.TabularInline):
 
 class WidgetAdmin(admin.ModelAdmin):
     list_display = ("name", "category", "description", "price")
+    form = VersionCheckedForm
+
 class OrderAdmin(admin.ModelAdmin):
     list_display = ("number",)
     inlines = [OrderItemInline]
@@ -0,0 +1,146 @@
+import base64
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework import exceptions
+
+
+def encode_cursor(ordering, values):
+    """
+    The cursor for the position `values` in `ordering`. It names the ordering
+    it belongs to, a cursor is only valid for the listing it came from.
+    """
+    values = [str(value) if isinstance(value, Decimal) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps({"sort": ",".join(ordering), "after": values})).rstrip("=")
+
+
+def ordering_fields(model, ordering):
+    """
+    The model fields of the columns in `ordering`, following relations.
+    """
+    fields = []
+    for name in ordering:
+        opts = model._meta
+        for part in name.lstrip("-").split("__"):
+            field = opts.get_field(part)
+            if field.is_relation:
+                opts = field.related_model._meta
+        fields.append(field)
+    return fields
+
+
+def decode_cursor(cursor, model, ordering):
+    """
+    The ordering values of the position `cursor` points at, each converted to
+    the type of its column. A cursor that is malformed, from another ordering
+    or holds values that do not fit the columns is a ValidationError.
+    """
+    try:
+        padded = str(cursor) + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise exceptions.ValidationError("Invalid cursor.")
+    if not isinstance(position, dict) or position.get("sort") != ",".join(ordering):
+        raise exceptions.ValidationError("Invalid cursor.")
+    values = position.get("after")
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise exceptions.ValidationError("Invalid cursor.")
+    if any(value is None or isinstance(value, (dict, list)) for value in values):
+        raise exceptions.ValidationError("Invalid cursor.")
+    try:
+        values = [field.to_python(value) for field, value in zip(ordering_fields(model, ordering), values)]
+    except DjangoValidationError:
+        raise exceptions.ValidationError("Invalid cursor.")
+    if any(isinstance(value, Decimal) and not value.is_finite() for value in values):
+        raise exceptions.ValidationError("Invalid cursor.")
+    return values
+
+
+def get_page_size(params):
+    page_size = params.get("page_size")
+    if not page_size:
+        return settings.WIDGET_PAGE_SIZE
+    if not page_size.isdigit() or int(page_size) == 0:
+        raise exceptions.ValidationError("Page size must be a positive integer.")
+    return min(int(page_size), settings.WIDGET_MAX_PAGE_SIZE)
+
+
+def wants_page(params):
+    return "cursor" in params or "page_size" in params
+
+
+class KeysetPaginator(object):
+    """
+    Cursor pagination over a fixed ordering.
+
+    The cursor is the ordering values of the last row on the page, so the next
+    page is fetched with range conditions on those columns instead of an
+    OFFSET, see `ranges`. The ordering has to end in a unique column
+    (normally "id") for the cursor to identify a single position.
+    """
+    def __init__(self, ordering, page_size):
+        self.ordering = ordering
+        self.page_size = page_size
+
+    def row_values(self, row):
+        values = []
+        for field in self.ordering:
+            value = row
+            for attr in field.lstrip("-").split("__"):
+                value = getattr(value, attr)
+            values.append(value)
+        return values
+
+    def ranges(self, values):
+        """
+        The rows after `values` as one condition per ordering column, in the
+        order the rows come: (a = x AND b > y), then (a > x). Each is a single
+        range of an index on the ordering columns. Their OR is not, so the
+        database would read the index from its start to the cursor.
+        """
+        ranges = []
+        for position in range(len(self.ordering) - 1, -1, -1):
+            conditions = dict((field.lstrip("-"), value) for field, value in zip(self.ordering[:position], values))
+            field = self.ordering[position]
+            lookup = "%s__lt" if field.startswith("-") else "%s__gt"
+            conditions[lookup % field.lstrip("-")] = values[position]
+            ranges.append(Q(**conditions))
+        return ranges
+
+    def paginate(self, queryset, cursor=None):
+        """
+        Returns the rows of the page following `cursor` and the cursor for the
+        page after that, which is None on the last page.
+        """
+        values = decode_cursor(cursor, queryset.model, self.ordering) if cursor else None
+        rows, has_next = self.page_after(queryset, values)
+        next_cursor = encode_cursor(self.ordering, self.row_values(rows[-1])) if has_next else None
+        return rows, next_cursor
+
+    def page_after(self, queryset, values):
+        queryset = queryset.order_by(*self.ordering)
+        if values is None:
+            rows = list(queryset[:self.page_size + 1])
+        else:
+            rows = []
+            for condition in self.ranges(values):
+                rows.extend(queryset.filter(condition)[:self.page_size + 1 - len(rows)])
+                if len(rows) > self.page_size:
+                    break
+        return rows[:self.page_size], len(rows) > self.page_size
+
+    def pages(self, queryset):
+        """
+        Yields every page of `queryset` in turn, each fetched with its own
+        query, so only one page is ever held in memory.
+        """
+        values = None
+        has_next = True
+        while has_next:
+            rows, has_next = self.page_after(queryset, values)
+            if rows:
+                yield rows
+                values = self.row_values(rows[-1])
@@ -0,0 +1,110 @@
+"""
+Per-request profiling. RequestProfilingMiddleware turns it on for a sample of
+requests and `profile_section` adds named timings to the current profile.
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger("widget.profiling")
+
+_local = threading.local()
+
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_LISTS = re.compile(r"\((?:\?, )+\?\)")
+
+
+@contextmanager
+def profile_section(name):
+    """
+    Adds the time spent in the block to `name` on the current request's
+    profile. Does nothing for requests that are not being profiled.
+    """
+    profile = getattr(_local, "profile", None)
+    if profile is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile[name] = profile.get(name, 0.0) + time.time() - start
+
+
+def normalize_sql(sql):
+    """
+    Reduces a query to its pattern, so that the same query repeated for
+    different ids (an N+1) can be spotted.
+    """
+    return SQL_LISTS.sub("(...)", SQL_LITERALS.sub("?", sql))
+
+
+def duplicate_queries(queries):
+    counts = Counter(normalize_sql(query["sql"]) for query in queries)
+    return [{"sql": sql, "count": count} for sql, count in counts.most_common() if count > 1]
+
+
+def server_timing(metrics):
+    return ", ".join(
+        '%s;dur=%.1f;desc="%s"' % (name, duration * 1000, desc) if desc else "%s;dur=%.1f" % (name, duration * 1000)
+        for name, duration, desc in metrics
+    )
+
+
+class RequestProfilingMiddleware(object):
+    """
+    Records the view, total time, time per profiled section, SQL query count
+    and time, and repeated query patterns for a sample of requests. The result
+    is added as a Server-Timing header and logged as JSON to widget.profiling.
+    WIDGET_PROFILING_SAMPLE_RATE is the fraction of requests profiled, the
+    rest only pay for one random() call.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.WIDGET_PROFILING_SAMPLE_RATE:
+            return self.get_response(request)
+
+        _local.profile = {}
+        force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        first_query = len(connection.queries_log)
+        start = time.time()
+        try:
+            response = self.get_response(request)
+        finally:
+            total = time.time() - start
+            connection.force_debug_cursor = force_debug_cursor
+            sections = _local.profile
+            del _local.profile
+
+        queries = list(connection.queries_log)[first_query:]
+        sql_time = sum(float(query["time"]) for query in queries)
+        duplicates = duplicate_queries(queries)
+        resolver_match = getattr(request, "resolver_match", None)
+
+        metrics = [("total", total, None), ("sql", sql_time, "%s queries" % len(queries))]
+        metrics.extend((name, duration, None) for name, duration in sorted(sections.items()))
+        response["Server-Timing"] = server_timing(metrics)
+
+        logger.info(json.dumps({
+            "view": resolver_match.view_name if resolver_match else None,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total * 1000, 2),
+            "sections_ms": dict((name, round(duration * 1000, 2)) for name, duration in sections.items()),
+            "queries": len(queries),
+            "sql_ms": round(sql_time * 1000, 2),
+            "duplicate_queries": duplicates,
+        }, sort_keys=True))
+        return response
@@ -0,0 +1,139 @@
+"""
+Response formats for the catalog and order endpoints, picked by content
+negotiation (Accept header or ?format=).
+
+FastJSONRenderer replaces DRF's JSONRenderer everywhere. CSVRenderer gives
+one row per widget or order item. MessagePackRenderer is offered when the
+msgpack package is installed.
+"""
+import csv
+import io
+import json
+from decimal import Decimal
+
+from django.utils import six
+from rest_framework.renderers import BaseRenderer, BrowsableAPIRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from widget.imports import FEATURE_SEPARATOR
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_fallback_encoder = JSONEncoder()
+
+
+def encode_default(obj):
+    # Serializers already turn nearly everything into JSON types, Decimal is
+    # checked first and everything else is left to DRF's encoder
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return _fallback_encoder.default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Compact JSON that stays on the C encoder's fast path. DRF's renderer asks
+    for unicode output, which the encoder escapes string by string in Python
+    on Python 2 before the result is encoded to UTF-8 again. Here the output
+    is ASCII, with non-ASCII characters (including U+2028 and U+2029)
+    escaped by the encoder itself. Indented output is left to DRF.
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super(FastJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        content = json.dumps(data, default=encode_default, separators=(",", ":"))
+        if isinstance(content, six.text_type):
+            content = content.encode("ascii")
+        return content
+
+
+def flatten(data, prefix=""):
+    """
+    One CSV row from an object, as (column, value) pairs. Nested objects
+    become "prefix.field" columns and lists of values one column joined with
+    "|", like the import format.
+    """
+    row = []
+    for key, value in data.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            row.extend(flatten(value, name + "."))
+        elif isinstance(value, list):
+            row.append((name, FEATURE_SEPARATOR.join(six.text_type(item) for item in value)))
+        else:
+            row.append((name, value))
+    return row
+
+
+def table(data):
+    """
+    The CSV rows of a response. A listing gives one row per widget, leaving
+    out its cursor and facets, and an object holding a list of objects, such
+    as an order with its items, one row per item with the order's fields
+    repeated.
+    """
+    if isinstance(data, dict) and isinstance(data.get("results"), list):
+        data = data["results"]
+    if isinstance(data, list):
+        return [flatten(row) if isinstance(row, dict) else [("value", row)] for row in data]
+    for key, value in data.items():
+        if isinstance(value, list) and value and isinstance(value[0], dict):
+            outer = [(name, other) for name, other in flatten(data) if name != key]
+            return [outer + flatten(item, key + ".") for item in value]
+    return [flatten(data)]
+
+
+class CSVRenderer(BaseRenderer):
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        rows = table(data)
+        columns = []
+        seen = set()
+        for row in rows:
+            for name, value in row:
+                if name not in seen:
+                    seen.add(name)
+                    columns.append(name)
+
+        stream = io.BytesIO() if six.PY2 else io.StringIO()
+        writer = csv.writer(stream)
+        writer.writerow([self.cell(name) for name in columns])
+        for row in rows:
+            values = dict(row)
+            writer.writerow([self.cell(values.get(name)) for name in columns])
+        content = stream.getvalue()
+        return content if six.PY2 else content.encode("utf-8")
+
+    def cell(self, value):
+        if value is None:
+            return ""
+        value = value if isinstance(value, six.text_type) else six.text_type(value)
+        return value.encode("utf-8") if six.PY2 else value
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        return msgpack.packb(data, use_bin_type=True, default=encode_default)
+
+
+# Renderers of the catalog and order endpoints, JSON first as the default
+CATALOG_RENDERERS = [FastJSONRenderer, BrowsableAPIRenderer, CSVRenderer]
+if msgpack is not None:
+    CATALOG_RENDERERS.append(MessagePackRenderer)
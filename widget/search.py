@@ -0,0 +1,369 @@
+"""
+Full-text search over widget names, descriptions and feature labels.
+
+SearchIndex is an in-process inverted index ranked with BM25. A widget
+matches when it has every word of the query, and the last word also matches
+as a prefix so results can be suggested while the customer is typing.
+
+Only the best few matches are scored. The postings of a term are grouped by
+term frequency and document length, which fix the score of a widget for the
+term, so they can be read best first. Every word of the query is read that
+way in turn, and the search stops once no widget it has not seen yet can
+score above the `limit` best found (the threshold algorithm), so a common
+word does not cost a pass over every widget that has it.
+"""
+import heapq
+import math
+import re
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+
+from widget.changes import changes_since
+from widget.index import CatalogIndex, incremental
+from widget.models import Widget, Feature
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# BM25 term frequency saturation and document length normalization
+K1 = 1.2
+B = 0.75
+
+# Prefixes whose merge of term streams is kept, see SearchIndex.word_stream
+MAX_CACHED_MERGES = 1000
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def inverse_document_frequency(count, document_frequency):
+    return math.log(1 + (count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+
+def weight(frequency, length, average_length):
+    """
+    The BM25 score of a term for a widget, before the term's inverse
+    document frequency.
+    """
+    return frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+
+
+class SearchIndex(CatalogIndex):
+    def clear(self):
+        # widget id -> tokens of its name and description
+        self.texts = {}
+        # widget id -> set of feature ids
+        self.widget_features = {}
+        # feature id -> tokens of its label
+        self.feature_tokens = {}
+        # feature id -> set of widget ids
+        self.feature_widgets = {}
+        # widget id -> Counter of the terms it is indexed under
+        self.documents = {}
+        # widget id -> number of tokens it is indexed under
+        self.lengths = {}
+        # term -> {widget id: term frequency}
+        self.postings = {}
+        # term -> {(term frequency, length): sorted widget ids}, the widgets
+        # of a group score the same for the term
+        self.groups = {}
+        self.total_length = 0
+        # sorted terms for prefix lookups, rebuilt when the vocabulary changes
+        self.terms = None
+        # terms -> start of their merge in word_stream, until the index changes
+        self.merges = {}
+
+    def load(self):
+        for feature_id, label in Feature.objects.values_list("id", "label"):
+            self.feature_tokens[feature_id] = tokenize(label)
+            self.feature_widgets[feature_id] = set()
+        for widget_id, name, description in Widget.objects.values_list("id", "name", "description"):
+            self.texts[widget_id] = tokenize(name) + tokenize(description)
+            self.widget_features[widget_id] = set()
+        for widget_id, feature_id in Widget.features.through.objects.values_list("widget_id", "feature_id"):
+            self.widget_features[widget_id].add(feature_id)
+            self.feature_widgets[feature_id].add(widget_id)
+        for widget_id in self.texts:
+            self.index(widget_id)
+
+    def catch_up(self, since):
+        changed, deleted = changes_since(since)
+        for widget_id in deleted["widget"]:
+            self.remove(widget_id)
+        for feature_id in deleted["feature"]:
+            self.feature_tokens.pop(feature_id, None)
+            self.feature_widgets.pop(feature_id, None)
+        for feature_id, label in changed["feature"].values_list("id", "label"):
+            self.feature_tokens[feature_id] = tokenize(label)
+            self.feature_widgets.setdefault(feature_id, set())
+        # Widgets whose features changed were stamped, see widget.signals
+        widget_ids = set()
+        for widget_id, name, description in changed["widget"].values_list("id", "name", "description"):
+            self.remove(widget_id)
+            self.texts[widget_id] = tokenize(name) + tokenize(description)
+            self.widget_features[widget_id] = set()
+            widget_ids.add(widget_id)
+        through = Widget.features.through.objects.filter(widget__change_seq__gt=since)
+        for widget_id, feature_id in through.values_list("widget_id", "feature_id"):
+            if widget_id in widget_ids:
+                self.widget_features[widget_id].add(feature_id)
+                self.feature_widgets.setdefault(feature_id, set()).add(widget_id)
+        for widget_id in widget_ids:
+            self.index(widget_id)
+
+    def index(self, widget_id):
+        """
+        (Re)indexes one widget from its text and its features' labels.
+        """
+        self.unindex(widget_id)
+        self.merges.clear()
+        if widget_id not in self.texts:
+            return
+        tokens = list(self.texts[widget_id])
+        for feature_id in self.widget_features[widget_id]:
+            tokens.extend(self.feature_tokens.get(feature_id, ()))
+        counts = Counter(tokens)
+        length = len(tokens)
+        for term, count in counts.items():
+            if term not in self.postings:
+                self.postings[term] = {}
+                self.groups[term] = {}
+                self.terms = None
+            self.postings[term][widget_id] = count
+            insort(self.groups[term].setdefault((count, length), []), widget_id)
+        self.documents[widget_id] = counts
+        self.lengths[widget_id] = length
+        self.total_length += length
+
+    def unindex(self, widget_id):
+        counts = self.documents.pop(widget_id, None)
+        if counts is None:
+            return
+        self.merges.clear()
+        length = self.lengths.pop(widget_id)
+        for term, count in counts.items():
+            postings = self.postings[term]
+            del postings[widget_id]
+            groups = self.groups[term]
+            group = groups[(count, length)]
+            del group[bisect_left(group, widget_id)]
+            if not group:
+                del groups[(count, length)]
+            if not postings:
+                del self.postings[term]
+                del self.groups[term]
+                self.terms = None
+        self.total_length -= length
+
+    def expand(self, prefix):
+        if self.terms is None:
+            self.terms = sorted(self.postings)
+        start = bisect_left(self.terms, prefix)
+        for term in self.terms[start:]:
+            if not term.startswith(prefix):
+                break
+            yield term
+
+    def search(self, query, limit):
+        """
+        Ids of the `limit` widgets best matching `query`, best first. Widgets
+        that score the same are ordered by id.
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        with self.lock:
+            self.ensure_built()
+            count = len(self.documents)
+            if not count:
+                return []
+            average_length = float(self.total_length) / count
+            idfs = {}
+
+            def idf(term):
+                if term not in idfs:
+                    idfs[term] = inverse_document_frequency(count, len(self.postings[term]))
+                return idfs[term]
+
+            # (word, its terms, whether it is matched as a prefix)
+            query_words = []
+            for position, word in enumerate(words):
+                prefix = position == len(words) - 1
+                terms = list(self.expand(word)) if prefix else [word] if word in self.postings else []
+                if not terms:
+                    return []
+                query_words.append((word, terms, prefix))
+
+            streams = [self.word_stream(word_terms, idf, average_length) for _, word_terms, _ in query_words]
+            heads = [next(stream, None) for stream in streams]
+            # (score, -widget id) of the best widgets so far, the worst first
+            best = []
+            seen = set()
+            while None not in heads:
+                if len(best) == limit:
+                    # No widget that has not been read yet scores above the
+                    # best scores left in every stream, and one scoring the
+                    # same has a higher id than any stream has reached
+                    threshold = sum(-score for score, widget_id in heads)
+                    worst_score, worst_id = best[0]
+                    if threshold < worst_score or (
+                        threshold == worst_score and -worst_id < max(widget_id for score, widget_id in heads)
+                    ):
+                        break
+                for position, stream in enumerate(streams):
+                    widget_id = heads[position][1]
+                    heads[position] = next(stream, None)
+                    if widget_id not in seen:
+                        seen.add(widget_id)
+                        score = self.score(widget_id, query_words, idf, average_length)
+                        if score is not None:
+                            if len(best) < limit:
+                                heapq.heappush(best, (score, -widget_id))
+                            elif (score, -widget_id) > best[0]:
+                                heapq.heapreplace(best, (score, -widget_id))
+                    if heads[position] is None:
+                        # Every widget matching all words is in this stream
+                        # and has been scored
+                        break
+        return [-negative_id for _, negative_id in sorted(best, reverse=True)]
+
+    def score(self, widget_id, query_words, idf, average_length):
+        """
+        The score of a widget for the query, None if it misses a word. A
+        widget matching a prefix through several terms counts its best one.
+        """
+        length = self.lengths[widget_id]
+        scores = []
+        for word, terms, prefix in query_words:
+            if prefix:
+                frequencies = [
+                    (term, frequency) for term, frequency in self.documents[widget_id].items() if term.startswith(word)
+                ]
+            else:
+                frequencies = [(word, self.documents[widget_id][word])] if word in self.documents[widget_id] else []
+            if not frequencies:
+                return None
+            scores.append(max(idf(term) * weight(frequency, length, average_length) for term, frequency in frequencies))
+        return sum(scores)
+
+    def term_stream(self, term, idf, average_length):
+        """
+        Yields (-score, widget id) of the widgets with `term`, best first.
+        """
+        scored = sorted(
+            ((idf * weight(frequency, length, average_length), ids)
+             for (frequency, length), ids in self.groups[term].items()),
+            key=itemgetter(0), reverse=True,
+        )
+        for score, group in groupby(scored, key=itemgetter(0)):
+            group = [ids for score, ids in group]
+            for widget_id in group[0] if len(group) == 1 else heapq.merge(*group):
+                yield -score, widget_id
+
+    def word_stream(self, terms, idf, average_length):
+        """
+        Yields (-score, widget id) of the widgets with any of `terms`, best
+        first, each widget once with its best score. The stream of a term is
+        only opened once the merge reaches the best score it can have.
+        """
+        if len(terms) == 1:
+            for head in self.term_stream(terms[0], idf(terms[0]), average_length):
+                yield head
+            return
+        # (-score, widget id, term) of the next widget of every stream. A
+        # stream not opened yet is in the merge with its best score and the
+        # lowest id with that score, which its first widget has. Setting this
+        # up for the thousands of terms a short prefix can have costs more
+        # than the rest of the search, so it is kept until the index changes.
+        key = tuple(terms)
+        if key not in self.merges:
+            heap = []
+            for term in terms:
+                best, widget_id = max(
+                    (weight(frequency, length, average_length), -ids[0])
+                    for (frequency, length), ids in self.groups[term].items()
+                )
+                heap.append((-idf(term) * best, -widget_id, term))
+            heapq.heapify(heap)
+            if len(self.merges) >= MAX_CACHED_MERGES:
+                self.merges.clear()
+            self.merges[key] = heap
+        heap = list(self.merges[key])
+        streams = {}
+        seen = set()
+        while heap:
+            score, widget_id, term = heap[0]
+            if term not in streams:
+                streams[term] = self.term_stream(term, idf(term), average_length)
+            elif widget_id not in seen:
+                seen.add(widget_id)
+                yield score, widget_id
+            head = next(streams[term], None)
+            if head is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, head + (term,))
+
+    @incremental
+    def widget_saved(self, widget):
+        self.texts[widget.pk] = tokenize(widget.name) + tokenize(widget.description)
+        self.widget_features.setdefault(widget.pk, set())
+        self.index(widget.pk)
+
+    @incremental
+    def widget_deleted(self, widget_id):
+        self.remove(widget_id)
+
+    def remove(self, widget_id):
+        self.unindex(widget_id)
+        self.texts.pop(widget_id, None)
+        for feature_id in self.widget_features.pop(widget_id, ()):
+            self.feature_widgets.get(feature_id, set()).discard(widget_id)
+
+    @incremental
+    def features_added(self, feature_ids, widget_ids):
+        self.change_features(feature_ids, widget_ids, added=True)
+
+    @incremental
+    def features_removed(self, feature_ids, widget_ids):
+        self.change_features(feature_ids, widget_ids, added=False)
+
+    def change_features(self, feature_ids, widget_ids, added):
+        for widget_id in widget_ids:
+            if widget_id not in self.widget_features:
+                continue
+            for feature_id in feature_ids:
+                widgets = self.feature_widgets.setdefault(feature_id, set())
+                if added:
+                    self.widget_features[widget_id].add(feature_id)
+                    widgets.add(widget_id)
+                else:
+                    self.widget_features[widget_id].discard(feature_id)
+                    widgets.discard(widget_id)
+            self.index(widget_id)
+
+    @incremental
+    def widget_features_cleared(self, widget_id):
+        self.change_features(list(self.widget_features.get(widget_id, ())), [widget_id], added=False)
+
+    @incremental
+    def feature_widgets_cleared(self, feature_id):
+        self.change_features([feature_id], list(self.feature_widgets.get(feature_id, ())), added=False)
+
+    @incremental
+    def feature_saved(self, feature):
+        self.feature_tokens[feature.pk] = tokenize(feature.label)
+        for widget_id in self.feature_widgets.setdefault(feature.pk, set()):
+            self.index(widget_id)
+
+    @incremental
+    def feature_deleted(self, feature_id):
+        self.feature_tokens.pop(feature_id, None)
+        for widget_id in self.feature_widgets.pop(feature_id, ()):
+            self.widget_features[widget_id].discard(feature_id)
+            self.index(widget_id)
+
+
+search_index = SearchIndex()
@@ -1,86 +1,316 @@
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models.functions import Cast
+from django.utils import six
 from rest_framework import serializers, fields
+from rest_framework.settings import api_settings
+from rest_framework.relations import ManyRelatedField, MANY_RELATION_KWARGS
+from rest_framework.utils import model_meta
+from rest_framework.validators import UniqueTogetherValidator
 
-from widget.models import Widget, Category, Feature, Order, OrderItem
+from widget.models import CheckoutJob, Widget, Category, Feature, Order, OrderItem
+from widget.profiling import profile_section
 
 
-class CategoryRepresentation(serializers.RelatedField):
-    def to_representation(self, obj):
-        return obj.name
+class ProfiledSerializerMixin(object):
+    """
+    Adds validation and representation time to the "serializer" section of
+    the request profile, see widget.profiling.
+    """
+    def is_valid(self, raise_exception=False):
+        with profile_section("serializer"):
+            return super(ProfiledSerializerMixin, self).is_valid(raise_exception=raise_exception)
 
-    def to_internal_value(self, data):
+    @property
+    def data(self):
+        with profile_section("serializer"):
+            return super(ProfiledSerializerMixin, self).data
+
+
+class ProfiledListSerializer(ProfiledSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+# Serializer fields that represent a value read from the database as it is
+PLAIN_FIELDS = (fields.IntegerField, fields.CharField)
+
+_compiled_rows = {}
+
+
+class DecimalText(Cast):
+    """
+    A decimal column as text with all of its decimal places, which is how
+    DecimalField represents it, without building Decimals in Python. sqlite
+    stores decimals as floats, so they are formatted rather than cast there.
+    """
+    def __init__(self, expression, max_digits, decimal_places):
+        # Room for every digit, the sign and the decimal point
+        super(DecimalText, self).__init__(expression, models.CharField(max_length=max_digits + 2))
+        self.decimal_places = decimal_places
+
+    def as_sqlite(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        template = "CASE WHEN %s IS NULL THEN NULL ELSE printf('%%%%.%df', %s) END"
+        return template % (sql, self.decimal_places, sql), params * 2
+
+
+def compile_rows(serializer):
+    """
+    Compiles the representation of `serializer` into a function that reads a
+    queryset with values_list, plus one query per many-to-many field, and
+    builds every row from the tuples directly instead of from instances field
+    by field. Decimals are formatted by the database, see DecimalText.
+    Returns None if some field cannot be read that way, which is the case for
+    anything but model fields and related fields with a `value_field`.
+    """
+    model = serializer.Meta.model
+    names = []
+    lookups = []
+    annotations = {}
+    converters = []
+    many = []
+    for field in serializer._readable_fields:
+        if len(field.source_attrs) != 1:
+            return None
         try:
-            try:
-                return Category.objects.get(id=int(data))
-            except KeyError:
-                raise serializers.ValidationError('Category is a required field.')
-            except ValueError:
-                raise serializers.ValidationError('Category must be an integer.')
-        except Category.DoesNotExist:
-            raise serializers.ValidationError('Category does not exist.')
+            model_field = model._meta.get_field(field.source_attrs[0])
+        except FieldDoesNotExist:
+            return None
+        index = len(names)
+        names.append(field.field_name)
+        if isinstance(field, ManyRelatedField):
+            value_field = getattr(field.child_relation, "value_field", None)
+            if value_field is None or not model_field.many_to_many:
+                return None
+            # Holds the row's pk until the related values are filled in
+            lookups.append("pk")
+            many.append((index, model_field.related_model._default_manager, model_field.related_query_name(), value_field))
+        elif isinstance(field, serializers.RelatedField):
+            value_field = getattr(field, "value_field", None)
+            if value_field is None or not model_field.many_to_one:
+                return None
+            lookups.append("%s__%s" % (model_field.name, value_field))
+        elif model_field.is_relation:
+            return None
+        elif (
+            type(field) is fields.DecimalField and not field.localize
+            and getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING)
+            and field.decimal_places == model_field.decimal_places
+        ):
+            name = "%s_text" % model_field.name
+            annotations[name] = DecimalText(model_field.name, model_field.max_digits, model_field.decimal_places)
+            lookups.append(name)
+        else:
+            lookups.append(model_field.name)
+            if type(field) not in PLAIN_FIELDS:
+                converters.append((index, field.to_representation))
+
+    def rows(queryset):
+        rows = [list(row) for row in queryset.prefetch_related(None).annotate(**annotations).values_list(*lookups)]
+        for index, manager, query_name, value_field in many:
+            values = {}
+            if rows:
+                related = manager.filter(**{query_name + "__in": [row[index] for row in rows]})
+                for pk, value in related.values_list(query_name, value_field):
+                    values.setdefault(pk, []).append(value)
+            for row in rows:
+                row[index] = values.get(row[index], [])
+        for index, convert in converters:
+            for row in rows:
+                if row[index] is not None:
+                    row[index] = convert(row[index])
+        return [OrderedDict(zip(names, row)) for row in rows]
+    return rows
+
+
+class CompiledListSerializer(ProfiledListSerializer):
+    """
+    Represents a queryset with the child serializer's compiled rows, see
+    compile_rows, and anything else, such as a page of instances, field by
+    field. Rows are compiled once per serializer class, so the child's fields
+    must not depend on the context.
+    """
+    def to_representation(self, data):
+        if isinstance(data, models.Manager):
+            data = data.all()
+        if isinstance(data, models.QuerySet):
+            child_class = type(self.child)
+            if child_class not in _compiled_rows:
+                _compiled_rows[child_class] = compile_rows(self.child)
+            if _compiled_rows[child_class] is not None:
+                return _compiled_rows[child_class](data)
+        return super(CompiledListSerializer, self).to_representation(data)
+
+
+def update_many(manager, objects):
+    """
+    Changes a many-to-many relation to `objects` by removing and adding only
+    the difference, so an unchanged relation is not written at all.
+    """
+    current = set(manager.values_list("pk", flat=True))
+    wanted = set(obj.pk for obj in objects)
+    manager.remove(*sorted(current - wanted))
+    manager.add(*[obj for obj in objects if obj.pk not in current])
+    return current != wanted
 
 
-class FeaturesRepresentation(serializers.RelatedField):
-    def to_representation(self, obj):
-        return obj.label
+class DirtyFieldsMixin(object):
+    """
+    Partial updates, and updates that write only what changed, for models with
+    a row version (see widget.versioning).
+
+    The `together_validators` check the fields in `validated_together`
+    against each other. They are skipped by a partial update that submits
+    none of them, and otherwise get the instance's values for the ones it
+    leaves out. Other validators, such as unique together ones, always run.
+    Updates diff many-to-many relations and then save just the changed
+    columns with update_fields, in the one write that also stamps the row for
+    the relations, see widget.signals. An update that changes nothing writes
+    nothing.
+    """
+    validated_together = ()
+    together_validators = ()
+
+    def run_validators(self, value):
+        if self.partial and self.instance is not None and isinstance(value, dict):
+            if not set(value).intersection(self.validated_together):
+                validators = self.validators
+                self.validators = [validator for validator in validators if validator not in self.together_validators]
+                try:
+                    return super(DirtyFieldsMixin, self).run_validators(value)
+                finally:
+                    self.validators = validators
+            value = dict(value)
+            for name in self.validated_together:
+                if name not in value:
+                    current = getattr(self.instance, name)
+                    value[name] = list(current.all()) if hasattr(current, "all") else current
+        super(DirtyFieldsMixin, self).run_validators(value)
+
+    def update(self, instance, validated_data):
+        info = model_meta.get_field_info(instance)
+        changed = []
+        many = []
+        for name, value in validated_data.items():
+            if name in info.relations and info.relations[name].to_many:
+                many.append((name, value))
+                continue
+            field = instance._meta.get_field(name)
+            # Compares foreign keys by id, without fetching the related object
+            if getattr(instance, field.attname) != (value.pk if field.is_relation else value):
+                setattr(instance, name, value)
+                changed.append(name)
+        instance._save_pending = True
+        try:
+            for name, value in many:
+                if update_many(getattr(instance, name), value):
+                    changed.append(name)
+        finally:
+            del instance._save_pending
+        if changed:
+            instance.save(update_fields=[name for name in changed if name not in dict(many)])
+        return instance
 
-    def to_internal_value(self, data):
+
+def resolve_ids(field, queryset, values, object_name):
+    """
+    Looks up the instances for submitted ids with one in_bulk query. Instances
+    are cached on the root serializer, so an id is only fetched once however
+    many fields or rows submit it.
+    """
+    ids = []
+    for value in values:
         try:
-            try:
-                return Feature.objects.get(id=int(data))
-            except KeyError:
-                raise serializers.ValidationError('Feature is a required field.')
-            except ValueError:
-                raise serializers.ValidationError('Feature must be an integer.')
-        except Feature.DoesNotExist:
-            raise serializers.ValidationError('Feature does not exist.')
+            ids.append(int(value))
+        except (TypeError, ValueError):
+            raise serializers.ValidationError('%s must be an integer.' % object_name)
 
+    resolved = field.root.__dict__.setdefault("_resolved_objects", {}).setdefault(queryset.model, {})
+    missing = set(ids).difference(resolved)
+    if missing:
+        resolved.update(queryset.in_bulk(list(missing)))
+    try:
+        return [resolved[pk] for pk in ids]
+    except KeyError:
+        raise serializers.ValidationError('%s does not exist.' % object_name)
+
+
+class BulkRelatedField(serializers.RelatedField):
+    """
+    Related field that accepts ids when writing and is represented by the
+    related object's `value_field`. With many=True all of the submitted ids
+    are resolved together instead of one query per id.
+    """
+    object_name = None
+    value_field = None
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs.keys():
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return BulkManyRelatedField(**list_kwargs)
+
+    def resolve(self, values):
+        return resolve_ids(self, self.get_queryset(), values, self.object_name)
+
+    def to_internal_value(self, data):
+        return self.resolve([data])[0]
 
-class WidgetsRepresentation(serializers.RelatedField):
     def to_representation(self, obj):
-        return obj.name
+        return getattr(obj, self.value_field)
+
 
+class BulkManyRelatedField(ManyRelatedField):
     def to_internal_value(self, data):
-        try:
-            try:
-                return Widget.objects.get(id=int(data))
-            except KeyError:
-                raise serializers.ValidationError('Widget is a required field.')
-            except ValueError:
-                raise serializers.ValidationError('Widget must be an integer.')
-        except Widget.DoesNotExist:
-            raise serializers.ValidationError('Widget does not exist.')
+        if isinstance(data, six.string_types) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        return self.child_relation.resolve(data)
+
+
+class CategoryRepresentation(BulkRelatedField):
+    object_name = 'Category'
+    value_field = 'name'
+
+
+class FeaturesRepresentation(BulkRelatedField):
+    object_name = 'Feature'
+    value_field = 'label'
+
+
+class WidgetsRepresentation(BulkRelatedField):
+    object_name = 'Widget'
+    value_field = 'name'
 
 
 def validate_features(data):
     for submitted_feature in data["features"]:
-        if submitted_feature.category != data["category"]:
+        if submitted_feature.category_id != data["category"].id:
             raise serializers.ValidationError("Features must all apply to chosen category.")
 
 
-class WidgetSerializer(serializers.ModelSerializer):
+class WidgetSerializer(DirtyFieldsMixin, ProfiledSerializerMixin, serializers.ModelSerializer):
     category = CategoryRepresentation(queryset=Category.objects.all())
     features = FeaturesRepresentation(many=True, queryset=Feature.objects.all())
+    validated_together = ("category", "features")
+    together_validators = (validate_features,)
 
     class Meta:
         model = Widget
         fields = ("id", "category", "price", "features", "name", "description", "quantity")
         validators = [validate_features]
+        list_serializer_class = CompiledListSerializer
 
 
-class OrderRepresentation(serializers.RelatedField):
-    def to_representation(self, obj):
-        return obj.id
-
-    def to_internal_value(self, data):
-        try:
-            try:
-                return Order.objects.get(id=int(data))
-            except KeyError:
-                raise serializers.ValidationError('Order is a required field.')
-            except ValueError:
-                raise serializers.ValidationError('Order must be an integer.')
-        except Order.DoesNotExist:
-            raise serializers.ValidationError('Order does not exist.')
+class OrderRepresentation(BulkRelatedField):
+    object_name = 'Order'
+    value_field = 'id'
 
 
 def validate_quantity(data):
@@ -101,25 +331,26 @@ class OrderItemWidgetRepresentation(WidgetSerializer):
         return fields.Field.get_value(*args, **kwargs)
 
     def to_internal_value(self, data):
-        try:
-            return Widget.objects.get(pk=data)
-        except Widget.DoesNotExist:
-            self.fail('does_not_exist', pk_value=data)
-        except (TypeError, ValueError):
-            self.fail('incorrect_type', data_type=type(data).__name__)
+        return resolve_ids(self, Widget.objects.all(), [data], 'Widget')[0]
 
     def to_representation(self, data):
         return WidgetSerializer.to_representation(self, data)
 
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(DirtyFieldsMixin, ProfiledSerializerMixin, serializers.ModelSerializer):
     widget = OrderItemWidgetRepresentation()
     order = OrderRepresentation(queryset=Order.objects.all())
+    validated_together = ("widget", "quantity")
+    together_validators = (validate_quantity,)
 
     class Meta:
         model = OrderItem
         fields = ("id", "quantity", "widget", "order")
-        validators = [validate_quantity]
+        validators = [
+            validate_quantity,
+            UniqueTogetherValidator(queryset=OrderItem.objects.all(), fields=("order", "widget")),
+        ]
+        list_serializer_class = ProfiledListSerializer
 
     def create(self, validated_data):
         order_item = OrderItem.objects.create(
@@ -130,14 +361,61 @@ class OrderItemSerializer(serializers.ModelSerializer):
         return order_item
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(source='orderitem_set', many=True, read_only=True)
     completed = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = Order
         fields = ("id", "number", "items", "completed")
+        list_serializer_class = ProfiledListSerializer
+
+
+class OrderLineSerializer(serializers.Serializer):
+    widget = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class OrderCreateSerializer(ProfiledSerializerMixin, serializers.Serializer):
+    """
+    Creates an order together with all of its items in one step. The ordered
+    widgets are fetched with a single query to check stock and the items are
+    inserted with one bulk_create. Lines for the same widget are merged.
+    """
+    items = OrderLineSerializer(many=True, allow_empty=False)
+
+    def validate(self, data):
+        quantities = OrderedDict()
+        for line in data["items"]:
+            quantities[line["widget"]] = quantities.get(line["widget"], 0) + line["quantity"]
+
+        widgets = Widget.objects.in_bulk(list(quantities))
+        if len(widgets) != len(quantities):
+            raise serializers.ValidationError("Widget does not exist.")
+
+        lines = []
+        for widget_id, quantity in quantities.items():
+            line = {"widget": widgets[widget_id], "quantity": quantity}
+            validate_quantity(line)
+            lines.append(line)
+        return {"items": lines}
 
     def create(self, validated_data):
         order = Order.objects.create()
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, widget=line["widget"], quantity=line["quantity"])
+            for line in validated_data["items"]
+        ])
         return order
+
+
+class CheckoutJobSerializer(serializers.ModelSerializer):
+    order = serializers.SlugRelatedField(slug_field="number", read_only=True)
+    errors = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CheckoutJob
+        fields = ("id", "order", "status", "errors", "created", "finished")
+
+    def get_errors(self, job):
+        return json.loads(job.errors) if job.errors else None
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 
 import os
 
+from widget.database import ENGINES, database_from_env, sqlite_tuned
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -29,8 +31,6 @@ ALLOWED_HOSTS = [
     "divineslayer.com",        
 ]
 
-STATIC_ROOT = os.path.join(BASE_DIR, "static")
-
 # Application definition
 
 INSTALLED_APPS = [
@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'widget.profiling.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,14 +80,31 @@ WSGI_APPLICATION = 'widget.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
+#
+# Configured from DATABASE_URL, see widget/database.py. Connections persist for
+# DATABASE_CONN_MAX_AGE seconds. Pooling across worker processes is left to a
+# pooler such as pgbouncer, set DATABASE_POOL_MODE=transaction when using one
+# in transaction mode.
 
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+    'default': database_from_env(os.environ, os.path.join(BASE_DIR, 'db.sqlite3')),
 }
 
+# Apply WAL, synchronous and mmap pragmas to sqlite connections,
+# disable with WIDGET_SQLITE_TUNED=0
+WIDGET_SQLITE_TUNED = sqlite_tuned(os.environ)
+
+# Seconds after which a logged catalog change is taken to be committed or
+# rolled back, so /widget/changes/ and the in-process indexes only go as far
+# as changes older than this, see widget/changes.py. A transaction that
+# records a change, such as an import batch, must commit within it. sqlite
+# commits one writer at a time, so nothing needs to settle there.
+WIDGET_CHANGE_SETTLE_TIME = 0 if DATABASES['default']['ENGINE'] == ENGINES['sqlite'] else 10
+
+# Days "manage.py compact_changes" keeps the change log for. Mirrors that have
+# not polled /widget/changes/ for longer have to fetch the whole catalog again.
+WIDGET_CHANGE_RETENTION_DAYS = 30
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -125,3 +143,99 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# "manage.py collectstatic" gathers the app's static files and the webpack
+# output in compiled/ ("npm run build" first) into STATIC_ROOT under hashed
+# names, with gzip and brotli variants, see widget/assets.py
+
+STATIC_ROOT = os.path.join(BASE_DIR, "static")
+
+STATICFILES_DIRS = [("compiled", os.path.join(BASE_DIR, "compiled"))]
+
+STATICFILES_STORAGE = 'widget.assets.CompressedManifestStaticFilesStorage'
+
+
+# Caching
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+#
+# Catalog reads are cached in WIDGET_CACHE_ALIAS until a widget, category or
+# feature changes. Any backend works; use a shared one such as
+# django.core.cache.backends.filebased.FileBasedCache when running several
+# processes so that they see each other's invalidations straight away.
+# Otherwise a process notices the others' changes from the change log within
+# WIDGET_CHANGE_CHECK_INTERVAL seconds.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+WIDGET_CACHE_ALIAS = 'default'
+
+WIDGET_CACHE_RESPONSES = True
+
+WIDGET_CACHE_TIMEOUT = 60 * 60
+
+WIDGET_CHANGE_CHECK_INTERVAL = 2
+
+# Answer unfiltered JSON catalog reads from the in-process snapshot, see
+# widget/snapshot.py
+
+WIDGET_CATALOG_SNAPSHOT = True
+
+
+# Catalog listing pagination, used when a request passes `cursor` or `page_size`
+
+WIDGET_PAGE_SIZE = 50
+
+WIDGET_MAX_PAGE_SIZE = 500
+
+# Widgets read per query when streaming /widget/export/
+
+WIDGET_EXPORT_CHUNK_SIZE = 500
+
+# Results returned by /widget/search/ unless the request passes `limit`
+
+WIDGET_SEARCH_LIMIT = 20
+
+
+# Queue order completion for "manage.py checkout_worker" instead of completing
+# orders in the request, see widget/checkout.py. Set WIDGET_CHECKOUT_QUEUE=1.
+
+WIDGET_CHECKOUT_QUEUE = os.environ.get('WIDGET_CHECKOUT_QUEUE') == '1'
+
+
+# Response formats, see widget/renderers.py. The catalog and order endpoints
+# also offer CSV and, when msgpack is installed, MessagePack.
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': (
+        'widget.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+}
+
+
+# Request profiling, see widget/profiling.py
+# Fraction of requests that get a Server-Timing header and a widget.profiling
+# log line, set with WIDGET_PROFILING_SAMPLE_RATE, e.g. 0.01 in production.
+
+WIDGET_PROFILING_SAMPLE_RATE = float(os.environ.get('WIDGET_PROFILING_SAMPLE_RATE', '0'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'widget.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,163 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from widget.cache import catalog_changed
+from widget.changes import record_change, stamp, stamp_widgets
+from widget.database import apply_sqlite_pragmas
+from widget.index import catalog_indexes
+from widget.models import Widget, Category, Feature, OrderItem
+
+
+@receiver(m2m_changed, sender=Widget.features.through)
+def widget_features_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    for index in catalog_indexes:
+        if reverse:
+            # Changed from the feature side, e.g. feature.widget_set.add(...)
+            if action == "post_add":
+                index.features_added([instance.pk], pk_set)
+            elif action == "post_remove":
+                index.features_removed([instance.pk], pk_set)
+            elif action == "post_clear":
+                index.feature_widgets_cleared(instance.pk)
+        else:
+            if action == "post_add":
+                index.features_added(pk_set, [instance.pk])
+            elif action == "post_remove":
+                index.features_removed(pk_set, [instance.pk])
+            elif action == "post_clear":
+                index.widget_features_cleared(instance.pk)
+    if action in ("post_add", "post_remove", "post_clear"):
+        catalog_changed()
+
+
+@receiver(post_save, sender=Widget)
+def widget_saved(sender, instance, **kwargs):
+    for index in catalog_indexes:
+        index.widget_saved(instance)
+
+
+@receiver(post_delete, sender=Widget)
+def widget_deleted(sender, instance, **kwargs):
+    for index in catalog_indexes:
+        index.widget_deleted(instance.pk)
+
+
+@receiver(post_save, sender=Feature)
+def feature_saved(sender, instance, **kwargs):
+    for index in catalog_indexes:
+        index.feature_saved(instance)
+
+
+@receiver(post_delete, sender=Feature)
+def feature_deleted(sender, instance, **kwargs):
+    for index in catalog_indexes:
+        index.feature_deleted(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, **kwargs):
+    for index in catalog_indexes:
+        index.category_saved(instance)
+
+
+@receiver(post_save, sender=Widget)
+@receiver(post_delete, sender=Widget)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Feature)
+@receiver(post_delete, sender=Feature)
+def catalog_saved(sender, **kwargs):
+    catalog_changed()
+
+
+@receiver(pre_save, sender=Widget)
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Feature)
+def record_saved(sender, instance, **kwargs):
+    # Written by the save itself, see StampedFieldsMixin. An object without an
+    # id yet is stamped once it has one
+    instance.change_seq = record_change(sender._meta.model_name, instance.pk) if instance.pk is not None else 0
+
+
+@receiver(post_save, sender=Widget)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Feature)
+def stamp_saved(sender, instance, **kwargs):
+    if not instance.change_seq:
+        instance.change_seq = record_change(sender._meta.model_name, instance.pk)
+        stamp(sender.objects.filter(pk=instance.pk), instance.change_seq)
+    # Widgets are listed with their category's name and their features' labels
+    if sender is Category:
+        stamp_widgets(Widget.objects.filter(category=instance), instance.change_seq, category_name=instance.name)
+    elif sender is Feature:
+        stamp_widgets(Widget.objects.filter(features=instance), instance.change_seq)
+
+
+@receiver(pre_delete, sender=Feature)
+def stamp_feature_widgets(sender, instance, **kwargs):
+    # The widgets lose the feature without an m2m_changed signal
+    stamp_widgets(Widget.objects.filter(features=instance), record_change("feature", instance.pk))
+
+
+@receiver(post_delete, sender=Widget)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Feature)
+def record_deleted(sender, instance, **kwargs):
+    record_change(sender._meta.model_name, instance.pk, deleted=True)
+
+
+@receiver(m2m_changed, sender=Widget.features.through)
+def stamp_widget_features(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear") and not getattr(instance, "_save_pending", False):
+            stamp_widgets(Widget.objects.filter(pk=instance.pk), record_change("widget", instance.pk))
+            # Keeps the instance at the version of its row, for its ETag
+            claimed = getattr(instance, "_claimed_version", None)
+            if claimed is not None:
+                instance.version = instance._claimed_version = claimed + 1
+            else:
+                instance.refresh_from_db(fields=["version"])
+    elif action in ("post_add", "post_remove"):
+        stamp_widgets(Widget.objects.filter(pk__in=pk_set), record_change("feature", instance.pk))
+    elif action == "pre_clear":
+        # Afterwards there is no telling which widgets had the feature
+        stamp_widgets(Widget.objects.filter(features=instance), record_change("feature", instance.pk))
+
+
+@receiver(pre_save, sender=Widget)
+def copy_fixture_category_name(sender, instance, raw, **kwargs):
+    # Fixtures are saved without Widget.save, which copies it otherwise
+    if raw:
+        names = Category.objects.filter(pk=instance.category_id).values_list("name", flat=True)
+        instance.category_name = names.first() or ""
+
+
+@receiver(pre_save, sender=Widget)
+@receiver(pre_save, sender=OrderItem)
+def bump_version(sender, instance, raw, **kwargs):
+    if raw or instance._state.adding:
+        return
+    claimed = getattr(instance, "_claimed_version", None)
+    if claimed is not None:
+        # The row is locked at that version, see widget.versioning.claim_version
+        instance.version = instance._claimed_version = claimed + 1
+    else:
+        # Incremented in the database, a save from a stale instance must not
+        # write a version that is already taken
+        instance.version = F("version") + 1
+
+
+@receiver(post_save, sender=Widget)
+@receiver(post_save, sender=OrderItem)
+def read_version(sender, instance, raw, **kwargs):
+    if not raw and hasattr(instance.version, "resolve_expression"):
+        instance.refresh_from_db(fields=["version"])
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor == "sqlite" and settings.WIDGET_SQLITE_TUNED:
+        apply_sqlite_pragmas(connection)
@@ -0,0 +1,276 @@
+"""
+In-process read model of the catalog for the JSON widget listing.
+
+Every widget is kept as its JSON rendering, produced once by WidgetSerializer,
+so listings are assembled by joining bytes instead of serializing each widget
+through DRF on every request. Only the unfiltered listing in its default order
+is served from here, filtered listings are left to the indexes of the
+database.
+
+The listing is ordered by category name with the database's collation, which
+Python cannot compare by. Categories are ranked by the database instead (see
+category_ranks) and widgets are kept in (rank, id) order.
+"""
+import sys
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.db import connection
+from django.utils.six.moves import range
+
+from widget.changes import changes_since
+from widget.index import CatalogIndex, incremental
+from widget.models import Category, Widget
+from widget.pagination import KeysetPaginator
+from widget.renderers import FastJSONRenderer
+from widget.serializers import WidgetSerializer
+
+
+class SnapshotWidget(object):
+    """
+    One widget of the snapshot. Entries are never modified, a widget that
+    changes is read again into a new entry.
+
+    Only what the unfiltered listing and the detail need is kept beside the
+    JSON. There are no price or quantity columns, listings filtered or
+    sorted on them are served by the database.
+    """
+    __slots__ = ("id", "category_id", "feature_ids", "version", "json")
+
+    def __init__(self, widget, json):
+        self.id = widget.id
+        self.category_id = widget.category_id
+        self.feature_ids = tuple(feature.id for feature in widget.features.all())
+        self.version = widget.version
+        self.json = json
+
+
+def category_ranks():
+    """
+    Maps category ids to the number of categories whose name the database
+    sorts before theirs. Names the collation takes to be equal, such as
+    differently cased names in a case insensitive one, share a rank.
+    """
+    quote = connection.ops.quote_name
+    table = quote(Category._meta.db_table)
+    pk = quote(Category._meta.pk.column)
+    name = quote(Category._meta.get_field("name").column)
+    sql = "SELECT c.%s, COUNT(d.%s) FROM %s c LEFT JOIN %s d ON d.%s < c.%s GROUP BY c.%s" % (
+        pk, pk, table, table, name, name, pk,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return dict(cursor.fetchall())
+
+
+class CatalogSnapshot(CatalogIndex):
+    """
+    Committed changes only mark the widgets they touch as stale. Stale widgets
+    are read again, in batches, by the next request that needs the snapshot,
+    and their entries are moved within the listing order. The whole listing
+    is only sorted again when a category is renamed.
+    """
+    def clear(self):
+        # widget id -> SnapshotWidget
+        self.widgets = {}
+        # category id -> name, the listing is ordered by it
+        self.categories = {}
+        # category id -> rank and category name -> rank, see category_ranks
+        self.ranks = {}
+        self.name_ranks = {}
+        # ids of widgets to read again before the snapshot is next used
+        self.stale = set()
+        # entries in listing order and their (category rank, id) keys, None
+        # until needed after a category is added or renamed
+        self.ordered = None
+        self.keys = None
+
+    def load(self):
+        for widget in self.read(Widget.objects.all()):
+            self.widgets[widget.id] = widget
+
+    def catch_up(self, since):
+        changed, deleted = changes_since(since)
+        for widget_id in deleted["widget"]:
+            self.remove(widget_id)
+        for category_id in deleted["category"]:
+            self.categories.pop(category_id, None)
+        for category_id, name in changed["category"].values_list("id", "name"):
+            self.rename(category_id, name)
+        # Widgets whose category or features changed were stamped, see
+        # widget.signals
+        self.update(changed["widget"])
+
+    def read(self, widgets):
+        """
+        Yields a new SnapshotWidget for each of `widgets`.
+        """
+        renderer = FastJSONRenderer()
+        widgets = widgets.select_related("category").prefetch_related("features")
+        paginator = KeysetPaginator(("id",), settings.WIDGET_EXPORT_CHUNK_SIZE)
+        for page in paginator.pages(widgets):
+            for widget, data in zip(page, WidgetSerializer(page, many=True).data):
+                self.rename(widget.category_id, widget.category.name)
+                yield SnapshotWidget(widget, renderer.render(data))
+
+    def update(self, widgets, widget_ids=()):
+        """
+        Reads `widgets` again, and drops those of `widget_ids` that are gone.
+        """
+        found = set()
+        for widget in self.read(widgets):
+            found.add(widget.id)
+            self.remove(widget.id)
+            self.widgets[widget.id] = widget
+            if self.ordered is not None and widget.category_id not in self.ranks:
+                self.ordered = None
+            if self.ordered is not None:
+                key = (self.ranks[widget.category_id], widget.id)
+                position = bisect_left(self.keys, key)
+                self.keys.insert(position, key)
+                self.ordered.insert(position, widget)
+        for widget_id in widget_ids:
+            if widget_id not in found:
+                self.remove(widget_id)
+
+    def remove(self, widget_id):
+        widget = self.widgets.pop(widget_id, None)
+        if widget is None or self.ordered is None:
+            return
+        position = bisect_left(self.keys, (self.ranks.get(widget.category_id), widget.id))
+        if position < len(self.ordered) and self.ordered[position] is widget:
+            del self.keys[position]
+            del self.ordered[position]
+        else:
+            self.ordered = None
+
+    def rename(self, category_id, name):
+        if self.categories.get(category_id) != name:
+            # Every widget of the category moves, or the category is new and
+            # has no rank yet
+            self.ordered = None
+        self.categories[category_id] = name
+
+    def refresh(self):
+        """
+        Brings the snapshot up to date. Called holding the lock.
+        """
+        self.ensure_built()
+        if self.stale:
+            stale = sorted(self.stale)
+            size = settings.WIDGET_EXPORT_CHUNK_SIZE
+            for start in range(0, len(stale), size):
+                widget_ids = stale[start:start + size]
+                self.update(Widget.objects.filter(id__in=widget_ids), widget_ids)
+            self.stale.clear()
+        if self.ordered is None:
+            self.ranks = category_ranks()
+            self.name_ranks = dict((self.categories[category_id], rank) for category_id, rank in self.ranks.items()
+                                   if category_id in self.categories)
+            # Widgets of categories deleted since are left out until the
+            # snapshot catches up with the deletion
+            keyed = sorted(
+                (self.ranks[widget.category_id], widget.id, widget)
+                for widget in self.widgets.values() if widget.category_id in self.ranks
+            )
+            self.keys = [(rank, widget_id) for rank, widget_id, widget in keyed]
+            self.ordered = [widget for rank, widget_id, widget in keyed]
+
+    def rows(self, after=None, limit=None):
+        """
+        (key, JSON) of the widgets in listing order, starting after the key
+        `after`. The key is the widget's (category name, id), the listing's
+        cursor. None when `after` names a category the snapshot cannot rank,
+        such as one renamed since, for the database to answer.
+        """
+        with self.lock:
+            self.refresh()
+            start = 0
+            if after:
+                name, widget_id = after
+                if name not in self.name_ranks:
+                    return None
+                start = bisect_right(self.keys, (self.name_ranks[name], widget_id))
+            stop = len(self.ordered) if limit is None else min(start + limit, len(self.ordered))
+            return [
+                ((self.categories[widget.category_id], widget.id), widget.json)
+                for widget in self.ordered[start:stop]
+            ]
+
+    def widget(self, widget_id):
+        """
+        The SnapshotWidget of one widget, None if there is no such widget.
+        """
+        with self.lock:
+            self.refresh()
+            return self.widgets.get(widget_id)
+
+    def memory(self):
+        """
+        Approximate bytes held by the snapshot, in total and per widget.
+        """
+        with self.lock:
+            self.refresh()
+            widgets = list(self.widgets.values())
+            json_bytes = sum(sys.getsizeof(widget.json) for widget in widgets)
+            entry_bytes = sum(sys.getsizeof(widget) + sys.getsizeof(widget.feature_ids) for widget in widgets)
+            index_bytes = (
+                sys.getsizeof(self.widgets) + sys.getsizeof(self.ordered) + sys.getsizeof(self.keys) +
+                sum(sys.getsizeof(key) for key in self.keys)
+            )
+        total = json_bytes + entry_bytes + index_bytes
+        return {
+            "widgets": len(widgets),
+            "json_bytes": json_bytes,
+            "entry_bytes": entry_bytes,
+            "index_bytes": index_bytes,
+            "bytes_per_widget": float(total) / len(widgets) if widgets else 0.0,
+        }
+
+    def with_feature(self, feature_id):
+        return [widget.id for widget in self.widgets.values() if feature_id in widget.feature_ids]
+
+    @incremental
+    def widget_saved(self, widget):
+        self.stale.add(widget.pk)
+
+    @incremental
+    def widgets_updated(self, widget_ids):
+        self.stale.update(widget_ids)
+
+    @incremental
+    def widget_deleted(self, widget_id):
+        self.remove(widget_id)
+        self.stale.discard(widget_id)
+
+    @incremental
+    def features_added(self, feature_ids, widget_ids):
+        self.stale.update(widget_ids)
+
+    @incremental
+    def features_removed(self, feature_ids, widget_ids):
+        self.stale.update(widget_ids)
+
+    @incremental
+    def widget_features_cleared(self, widget_id):
+        self.stale.add(widget_id)
+
+    @incremental
+    def feature_widgets_cleared(self, feature_id):
+        self.stale.update(self.with_feature(feature_id))
+
+    @incremental
+    def feature_saved(self, feature):
+        self.stale.update(self.with_feature(feature.pk))
+
+    @incremental
+    def feature_deleted(self, feature_id):
+        self.stale.update(self.with_feature(feature_id))
+
+    @incremental
+    def category_saved(self, category):
+        self.rename(category.pk, category.name)
+        self.stale.update(widget.id for widget in self.widgets.values() if widget.category_id == category.pk)
+
+
+catalog_snapshot = CatalogSnapshot()
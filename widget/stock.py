@@ -0,0 +1,34 @@
+from django.db.models import F
+
+from widget.cache import catalog_changed
+from widget.changes import record_change
+from widget.index import widgets_updated
+from widget.models import Widget
+
+
+def reserve_stock(demand):
+    """
+    Takes ordered quantities off widget stock, `demand` mapping widget ids to
+    the quantity wanted. Each limited widget is decremented by one conditional
+    UPDATE, so two checkouts can never both take the last units, and widgets
+    are updated in id order so concurrent checkouts lock rows in the same
+    order. Widgets with unlimited (NULL) quantity are left alone.
+
+    Returns the ids of the widgets that did not have enough stock. Nothing is
+    undone here, the caller is expected to roll back its transaction.
+    """
+    limited = sorted(Widget.objects.filter(id__in=list(demand), quantity__isnull=False).values_list("id", flat=True))
+    short = []
+    # One change for the whole reservation, see widget.changes
+    seq = record_change("widget") if limited else None
+    for widget_id in limited:
+        quantity = demand[widget_id]
+        updated = Widget.objects.filter(id=widget_id, quantity__gte=quantity).update(
+            quantity=F("quantity") - quantity, change_seq=seq, version=F("version") + 1
+        )
+        if not updated:
+            short.append(widget_id)
+    if limited:
+        widgets_updated(limited)
+        catalog_changed()
+    return short
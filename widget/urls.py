@@ -13,17 +13,31 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
+import re
+
+from django.conf import settings
 from django.conf.urls import url
 from django.contrib import admin
 
-from widget.views import ui, widget_, order_, order_item, order_complete
+from widget.assets import static_asset
+from widget.views import (
+    ui, widget_, widget_search, widget_changes, widget_cache, widget_import, widget_export, order_, order_item,
+    order_complete, checkout_job,
+)
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
 
     url('^$', ui),
     url(r'^widget/(?P<widget_id>[0-9]+)?/?$', widget_),
+    url(r'^widget/search/?$', widget_search),
+    url(r'^widget/changes/?$', widget_changes),
+    url(r'^widget/cache/?$', widget_cache),
+    url(r'^widget/import/?$', widget_import),
+    url(r'^widget/export/?$', widget_export),
     url(r'^order/(?P<order_number>[a-f0-9]{10})?/?$', order_),
     url(r'^order/(?P<order_number>[a-f0-9]{10})/complete/$', order_complete),
     url(r'^order/item/(?P<order_item_id>[0-9]+)?/?$', order_item),
+    url(r'^order/job/(?P<job_id>[0-9]+)/?$', checkout_job),
+    url(r'^%s(?P<path>.+)$' % re.escape(settings.STATIC_URL.lstrip('/')), static_asset),
 ]
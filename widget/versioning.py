@@ -0,0 +1,91 @@
+"""
+Optimistic concurrency for updates. Widgets and order items carry a row
+version that every save increments. GETs return it as the ETag, and a PUT
+with If-Match writes only if the row is still at that version, otherwise it
+is answered with 412 Precondition Failed.
+"""
+import re
+
+from django import forms
+from django.db import transaction
+from django.db.models import F
+from rest_framework import status
+from rest_framework.response import Response
+
+ETAG_PATTERN = re.compile(r'^"v(\d+)"$')
+
+
+def version_etag(instance):
+    return '"v%d"' % instance.version
+
+
+def if_match_versions(request):
+    """
+    The versions listed in the If-Match header of `request`, None when there
+    is no header or it is "*". If-Match compares strong ETags, so weak ones
+    and tags that are not versions never match.
+    """
+    header = request.META.get("HTTP_IF_MATCH")
+    if header is None or header.strip() == "*":
+        return None
+    versions = []
+    for tag in header.split(","):
+        match = ETAG_PATTERN.match(tag.strip())
+        if match:
+            versions.append(int(match.group(1)))
+    return versions
+
+
+def claim_version(instance, versions):
+    """
+    Locks the row of `instance` for the rest of the transaction if it is
+    still at the version `instance` was read at, with an UPDATE ... WHERE
+    version = n that changes nothing, so that of concurrent writers that read
+    the same version only one gets to save. Returns False if `instance` is
+    not at one of `versions` or the row has changed since it was read. With
+    `versions` None only the latter is checked, so an update without If-Match
+    still never overwrites a version it has not seen. Must run in the
+    transaction that then saves `instance`, whose save increments the version.
+    Until that transaction commits the instance knows its row's version, so
+    its saves write the next one outright, see widget.signals.bump_version.
+    """
+    if versions is not None and instance.version not in versions:
+        return False
+    model = type(instance)
+    claimed = model.objects.filter(pk=instance.pk, version=instance.version).update(version=F("version"))
+    if claimed != 1:
+        return False
+    instance._claimed_version = instance.version
+    transaction.on_commit(lambda: instance.__dict__.pop("_claimed_version", None))
+    return True
+
+
+class VersionCheckedForm(forms.ModelForm):
+    """
+    Admin form that does not save over changes made after it was opened. It
+    carries the version it was rendered at and claims it, like a PUT with
+    If-Match.
+    """
+    row_version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(VersionCheckedForm, self).__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.fields["row_version"].initial = self.instance.version
+
+    def clean(self):
+        cleaned_data = super(VersionCheckedForm, self).clean()
+        if self.instance.pk is not None:
+            versions = [cleaned_data.get("row_version")]
+            if not claim_version(self.instance, versions):
+                raise forms.ValidationError(
+                    "This %s was changed since the page was opened, reload it." % self.instance._meta.verbose_name
+                )
+        return cleaned_data
+
+
+def precondition_failed(instance):
+    return Response(
+        {"detail": "The %s was changed since it was read." % instance._meta.verbose_name},
+        status=status.HTTP_412_PRECONDITION_FAILED,
+    )
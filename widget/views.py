@@ -1,43 +1,257 @@
-from operator import or_
+import json
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
 
-from django.db.models import Q
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Count, Prefetch, Q, prefetch_related_objects
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from rest_framework import exceptions
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.response import Response
 from rest_framework import status
 
-from widget.models import Widget, Order, OrderItem, Category
-from widget.serializers import WidgetSerializer, OrderSerializer, OrderItemSerializer
+from widget.cache import cached_catalog_value, cached_catalog_view, stats as cache_stats
+from widget.changes import changes_since, latest_seq, oldest_seq
+from widget.checkout import enqueue_checkout, order_demand, stock_errors
+from widget.imports import WidgetImporter, read_csv, read_ndjson
+from widget.index import feature_index
+from widget.models import CheckoutJob, Widget, Order, OrderItem, Category
+from widget.pagination import KeysetPaginator, decode_cursor, encode_cursor, get_page_size, wants_page
+from widget.profiling import profile_section
+from widget.renderers import CATALOG_RENDERERS, FastJSONRenderer
+from widget.search import search_index
+from widget.serializers import (
+    CheckoutJobSerializer, WidgetSerializer, OrderSerializer, OrderCreateSerializer, OrderItemSerializer,
+)
+from widget.snapshot import catalog_snapshot
+from widget.stock import reserve_stock
+from widget.versioning import claim_version, if_match_versions, precondition_failed, version_etag
 
+WIDGET_ORDERING = ("category_name", "id")
 
-@api_view(["GET", "POST", "PUT"])
-def widget_(request, widget_id=None):
-    if request.method == "GET":
+# Orderings selectable with `sort`. Each ends in a unique column, as the
+# keyset cursor needs, and is backed by an index (see Widget.Meta).
+WIDGET_SORTS = {
+    "price": ("price", "id"),
+    "-price": ("-price", "-id"),
+    "name": ("name",),
+}
+
+IN_STOCK_VALUES = {"1": True, "true": True, "0": False, "false": False}
+
+WidgetFilters = namedtuple("WidgetFilters", ("category_id", "feature_ids", "min_price", "max_price", "in_stock"))
+
+
+def parse_price(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise exceptions.ValidationError("%s must be a number." % name)
+    if not price.is_finite():
+        raise exceptions.ValidationError("%s must be a number." % name)
+    return price
+
+
+def parse_filters(params):
+    """
+    The filters of the widget listing in `params`. The feature filter is a
+    list of sets of feature ids, and a widget matches with a feature of every
+    set. The category id and the feature filter are None when the listing is
+    not filtered on them, as are the price bounds and in_stock.
+    """
+    category_id = params.get("category")
+    category_id = int(category_id) if category_id and category_id.isdigit() else None
+
+    feature_ids = None
+    # getlist on a QueryDict acts like it is multiple values coming from a checkbox with the same key
+    features = params.getlist("features")
+    if features:
+        match = params.get("match", "any")
+        if match not in ("any", "all"):
+            raise exceptions.ValidationError("Match must be either any or all.")
+        feature_ids = feature_index.feature_ids(features)
+        if match == "any":
+            feature_ids = [set.union(*feature_ids)]
+
+    in_stock = params.get("in_stock")
+    if in_stock:
+        if in_stock.lower() not in IN_STOCK_VALUES:
+            raise exceptions.ValidationError("in_stock must be true or false.")
+        in_stock = IN_STOCK_VALUES[in_stock.lower()]
+    else:
+        in_stock = None
+
+    return WidgetFilters(category_id, feature_ids, parse_price(params, "min_price"), parse_price(params, "max_price"), in_stock)
+
+
+def get_ordering(params):
+    sort = params.get("sort")
+    if not sort:
+        return WIDGET_ORDERING
+    if sort not in WIDGET_SORTS:
+        raise exceptions.ValidationError("Sort must be one of %s." % ", ".join(sorted(WIDGET_SORTS)))
+    return WIDGET_SORTS[sort]
+
+
+def filter_widgets(params):
+    widgets = Widget.objects.all()
+    filters = parse_filters(params)
+    if filters.category_id is not None:
+        widgets = widgets.filter(category__id=filters.category_id)
+    if filters.feature_ids is not None:
+        links = Widget.features.through.objects
+        for feature_ids in filters.feature_ids:
+            widgets = widgets.filter(id__in=links.filter(feature_id__in=sorted(feature_ids)).values("widget_id"))
+    if filters.min_price is not None:
+        widgets = widgets.filter(price__gte=filters.min_price)
+    if filters.max_price is not None:
+        widgets = widgets.filter(price__lte=filters.max_price)
+    if filters.in_stock is not None:
+        # A NULL quantity is unlimited stock
+        in_stock = Q(quantity__isnull=True) | Q(quantity__gt=0)
+        widgets = widgets.filter(in_stock if filters.in_stock else ~in_stock)
+    return widgets
+
+
+def facet_counts(params):
+    """
+    Widget counts per category and per feature for the filter in `params`.
+    Categories are counted without the category filter, so that the counts
+    show what picking another category would give. Counts are cached per
+    filter, pages of one listing share them.
+    """
+    def compute():
+        other_categories = params.copy()
+        other_categories.pop("category", None)
+        categories = (
+            filter_widgets(other_categories)
+            .values("category_id", "category__name")
+            .annotate(count=Count("id"))
+            .order_by("category__name", "category_id")
+        )
+        features = (
+            Widget.features.through.objects
+            .filter(widget__in=filter_widgets(params))
+            .values("feature_id", "feature__label")
+            .annotate(count=Count("widget_id"))
+            .order_by("feature__label", "feature_id")
+        )
+        return {
+            "category": [
+                {"id": row["category_id"], "name": row["category__name"], "count": row["count"]}
+                for row in categories
+            ],
+            "features": [
+                {"id": row["feature_id"], "label": row["feature__label"], "count": row["count"]}
+                for row in features
+            ],
+        }
+
+    filter_state = (
+        params.get("category"),
+        sorted(feature.lower() for feature in params.getlist("features")),
+        params.get("match"),
+        params.get("min_price"),
+        params.get("max_price"),
+        params.get("in_stock"),
+    )
+    return cached_catalog_value("facets", filter_state, compute)
+
+
+def snapshot_response(request, widget_id):
+    """
+    The JSON response to a widget_ GET assembled from the pre-rendered widgets
+    of the catalog snapshot, without serializing them or querying the
+    database. Returns None for a widget that does not exist and for listings
+    that are filtered or sorted other than by category, which are left to the
+    indexed queries of the regular path.
+    """
+    if not widget_id and (get_ordering(request.GET) != WIDGET_ORDERING or any(
+        value is not None for value in parse_filters(request.GET)
+    )):
+        return None
+    with profile_section("snapshot"):
         if widget_id:
-            widget = Widget.objects.get(id=int(widget_id))
-            return Response(WidgetSerializer(widget).data)
+            widget = catalog_snapshot.widget(int(widget_id))
+            if widget is None:
+                return None
+            response = HttpResponse(widget.json, content_type="application/json")
+            response["ETag"] = version_etag(widget)
+            return response
 
-        widgets = Widget.objects.all()
+        fields = []
+        if wants_page(request.GET):
+            page_size = get_page_size(request.GET)
+            cursor = request.GET.get("cursor")
+            after = decode_cursor(cursor, Widget, WIDGET_ORDERING) if cursor else None
+            rows = catalog_snapshot.rows(after, page_size + 1)
+            if rows is None:
+                return None
+            next_cursor = encode_cursor(WIDGET_ORDERING, rows[page_size - 1][0]) if len(rows) > page_size else None
+            rows = rows[:page_size]
+            fields.append((b"next", json.dumps(next_cursor).encode("ascii")))
+        else:
+            rows = catalog_snapshot.rows()
+        results = b"[" + b",".join(content for key, content in rows) + b"]"
 
-        category_id = request.GET.get("category")
-        if category_id and category_id.isdigit():
-            widgets = widgets.filter(category__id=category_id)
+        if request.GET.get("facets"):
+            fields.append((b"facets", FastJSONRenderer().render(facet_counts(request.GET))))
+        if fields:
+            fields.insert(0, (b"results", results))
+            content = b"{" + b",".join(b'"' + name + b'":' + value for name, value in fields) + b"}"
+        else:
+            content = results
+        return HttpResponse(content, content_type="application/json")
 
-        # getlist on a QueryDict acts like it is multiple values coming from a checkbox with the same key
-        features = request.GET.getlist("features")
-        if features:
-            feature_filters = []
-            for feature in features:
-                feature_filters.append(Q(features__label__icontains=feature))
-            widgets = widgets.filter(reduce(or_, feature_filters))
 
-        widgets = widgets.order_by("category__name")
+def prefetch_order_items(orders):
+    """
+    Fetches the items of `orders` together with their widgets, categories and
+    features, in two queries however many items there are.
+    """
+    items = OrderItem.objects.select_related("widget__category").prefetch_related("widget__features")
+    prefetch_related_objects(orders, Prefetch("orderitem_set", queryset=items))
+
+
+@cached_catalog_view
+@api_view(["GET", "POST", "PUT", "PATCH"])
+@renderer_classes(CATALOG_RENDERERS)
+def widget_(request, widget_id=None):
+    if request.method == "GET":
+        if settings.WIDGET_CATALOG_SNAPSHOT and request.accepted_renderer.format == "json":
+            response = snapshot_response(request, widget_id)
+            if response is not None:
+                return response
+
+        if widget_id:
+            widget = Widget.objects.get(id=int(widget_id))
+            return Response(WidgetSerializer(widget).data, headers={"ETag": version_etag(widget)})
+
+        widgets = filter_widgets(request.GET)
         widgets = widgets.select_related("category").prefetch_related("features")
-        widgets = widgets.all()
 
-        return Response(WidgetSerializer(widgets, many=True).data)
+        ordering = get_ordering(request.GET)
+        if wants_page(request.GET):
+            paginator = KeysetPaginator(ordering, get_page_size(request.GET))
+            page, next_cursor = paginator.paginate(widgets, request.GET.get("cursor"))
+            body = {
+                "results": WidgetSerializer(page, many=True).data,
+                "next": next_cursor,
+            }
+        else:
+            widgets = widgets.order_by(*ordering)
+            if not request.GET.get("facets"):
+                return Response(WidgetSerializer(widgets, many=True).data)
+            body = {"results": WidgetSerializer(widgets, many=True).data}
+
+        if request.GET.get("facets"):
+            body["facets"] = facet_counts(request.GET)
+        return Response(body)
     elif request.method == "POST":
         serializer = WidgetSerializer(data=request.data)
         if serializer.is_valid():
@@ -45,20 +259,145 @@ def widget_(request, widget_id=None):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-    elif request.method == "PUT":
+    elif request.method in ("PUT", "PATCH"):
         if not widget_id:
             raise exceptions.ValidationError("Widget id necessary")
-        widget = Widget.objects.get(id=int(widget_id))
-
-        serializer = WidgetSerializer(widget, data=request.data)
-        if serializer.is_valid():
+        with transaction.atomic():
+            widget = Widget.objects.get(id=int(widget_id))
+            serializer = WidgetSerializer(widget, data=request.data, partial=request.method == "PATCH")
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            if not claim_version(widget, if_match_versions(request)):
+                return precondition_failed(widget)
             serializer.save()
-            return Response(serializer.data)
-        else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.data, headers={"ETag": version_etag(widget)})
+
+
+@cached_catalog_view
+@api_view(["GET"])
+@renderer_classes(CATALOG_RENDERERS)
+def widget_search(request):
+    """
+    Widgets matching every word of `q` in their name, description or feature
+    labels, best match first. The last word also matches as a prefix, for
+    suggestions while typing.
+    """
+    limit = request.GET.get("limit")
+    if not limit:
+        limit = settings.WIDGET_SEARCH_LIMIT
+    elif not limit.isdigit() or int(limit) == 0:
+        raise exceptions.ValidationError("Limit must be a positive integer.")
+    limit = min(int(limit), settings.WIDGET_MAX_PAGE_SIZE)
+
+    widget_ids = search_index.search(request.GET.get("q", ""), limit)
+    widgets = Widget.objects.select_related("category").prefetch_related("features").in_bulk(widget_ids)
+    # Widgets deleted since the index was read are left out
+    widgets = [widgets[widget_id] for widget_id in widget_ids if widget_id in widgets]
+    return Response(WidgetSerializer(widgets, many=True).data)
+
+
+@cached_catalog_view
+@api_view(["GET"])
+def widget_changes(request):
+    """
+    What changed in the catalog after the sequence number `since`: the
+    changed categories, features and widgets in full and the ids of deleted
+    ones, or the whole catalog without `since`. Mirrors pass the returned
+    `seq` as `since` on their next poll. `seq` is the settled sequence
+    number, see widget.changes, so no change numbered up to it can still be
+    committed after the response. A `since` older than the compacted change
+    log is answered with 410 Gone, its mirror has to start over without it.
+    """
+    since = request.GET.get("since")
+    if since is not None and not since.isdigit():
+        raise exceptions.ValidationError("Since must be a non-negative integer.")
+    if since is not None and int(since) < oldest_seq():
+        return Response(
+            {"detail": "Changes after %s were compacted, fetch the catalog again without since." % since},
+            status=status.HTTP_410_GONE,
+        )
+
+    # Read first, so changes committed while this runs are sent again next time
+    seq = latest_seq()
+    changed, deleted = changes_since(int(since) if since is not None else None)
+    widgets = changed["widget"].select_related("category").prefetch_related("features")
+    return Response({
+        "seq": seq,
+        "categories": list(changed["category"].values("id", "name", "label")),
+        "features": [
+            {"id": feature_id, "label": label, "category": category_id}
+            for feature_id, label, category_id in changed["feature"].values_list("id", "label", "category_id")
+        ],
+        "widgets": WidgetSerializer(widgets, many=True).data,
+        "deleted": {
+            "categories": deleted["category"],
+            "features": deleted["feature"],
+            "widgets": deleted["widget"],
+        },
+    })
+
+
+@api_view(["GET"])
+def widget_cache(request):
+    """
+    The catalog generation and the hit and miss counters of the cached
+    catalog views, as this serving process sees them, see
+    widget.cache.stats.
+    """
+    return Response(cache_stats())
+
+
+# Request body formats accepted by widget_import
+IMPORT_READERS = {"text/csv": read_csv, "application/x-ndjson": read_ndjson}
+
+
+@api_view(["POST"])
+def widget_import(request):
+    """
+    Imports widgets from a CSV or NDJSON request body, read as a stream, and
+    returns the counts and the errors per line, see widget.imports.
+    """
+    content_type = request.content_type.split(";")[0].strip()
+    reader = IMPORT_READERS.get(content_type)
+    if reader is None:
+        raise exceptions.UnsupportedMediaType(content_type)
+    result = WidgetImporter().run(reader(request.stream or []))
+    return Response(result.as_dict())
+
+
+@api_view(["GET"])
+def widget_export(request):
+    """
+    Streams the catalog, with the same filters as the listing, as one JSON
+    array or with ndjson=1 as one JSON object per line. Widgets are read in
+    keyset pages of WIDGET_EXPORT_CHUNK_SIZE, so memory use does not grow
+    with the size of the catalog.
+    """
+    widgets = filter_widgets(request.GET)
+    widgets = widgets.select_related("category").prefetch_related("features")
+    pages = KeysetPaginator(get_ordering(request.GET), settings.WIDGET_EXPORT_CHUNK_SIZE).pages(widgets)
+    renderer = FastJSONRenderer()
+
+    def rows():
+        for page in pages:
+            for row in WidgetSerializer(page, many=True).data:
+                yield renderer.render(row)
+
+    if request.GET.get("ndjson"):
+        content = (row + b"\n" for row in rows())
+        return StreamingHttpResponse(content, content_type="application/x-ndjson")
+
+    def array():
+        separator = b"["
+        for row in rows():
+            yield separator + row
+            separator = b","
+        yield b"]" if separator == b"," else b"[]"
+    return StreamingHttpResponse(array(), content_type="application/json")
 
 
 @api_view(["GET", "POST", "PUT", "DELETE"])
+@renderer_classes(CATALOG_RENDERERS)
 @transaction.atomic
 def order_(request, order_number=None):
     if request.method == "GET":
@@ -68,25 +407,25 @@ def order_(request, order_number=None):
             order = Order.objects.get(number=order_number, completed=False)
         except Order.DoesNotExist:
             raise exceptions.ValidationError("Order does not exist")
+        prefetch_order_items([order])
         return Response(OrderSerializer(order).data)
     elif request.method == "POST":
-        order_serializer = OrderSerializer(data=request.data)
-
-        if order_serializer.is_valid():
-            with transaction.atomic():
-                order_serializer.save()
-                order_id = order_serializer.data["id"]
-                data_with_order_id = dict(request.data.items() + [("order", str(order_id))])
-                order_item_serializer = OrderItemSerializer(data=data_with_order_id)
-                if order_item_serializer.is_valid():
-                    order_item_serializer.save()
-                else:
-                    raise exceptions.ValidationError(order_item_serializer.errors)
-            data = dict(order_serializer.data.items())
-            data["items"] = [dict(order_item_serializer.data.items())]
-            return Response(data, status=status.HTTP_201_CREATED)
+        data = request.data
+        if isinstance(data, list):
+            data = {"items": data}
+        elif not isinstance(data, dict):
+            raise exceptions.ValidationError("Expected an order or a list of order lines.")
+        if "items" not in data:
+            # A single item can still be posted as flat widget and quantity fields
+            data = {"items": [{"widget": data.get("widget"), "quantity": data.get("quantity")}]}
+
+        serializer = OrderCreateSerializer(data=data)
+        if serializer.is_valid():
+            order = serializer.save()
+            prefetch_order_items([order])
+            return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
         else:
-            return Response(order_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     elif request.method == "DELETE":
         order = Order.objects.get(number=order_number)
         order.delete()
@@ -97,28 +436,51 @@ def order_(request, order_number=None):
 @transaction.atomic
 def order_complete(request, order_number):
     order = Order.objects.get(number=order_number)
-    order_items = OrderItem.objects.filter(order=order).select_related().all()
-    for order_item in order_items:
-        # If ordered widget quantity is unlimited, there is no need to reduce it
-        if order_item.widget.quantity is not None:
-            # Only remove quantity if the widget can satisfy the order
-            if order_item.widget.quantity > order_item.quantity:
-                order_item.widget.quantity -= order_item.quantity
-                order_item.widget.save()
-            else:
-                raise exceptions.ValidationError("Not enough stock to fulfill order")
-    order.completed = True
-    order.save()
+    if settings.WIDGET_CHECKOUT_QUEUE:
+        job, created = enqueue_checkout(order)
+        if job is None:
+            raise exceptions.ValidationError("Order is already completed")
+        # An order queued before answers with its existing job
+        return Response(
+            CheckoutJobSerializer(job).data, status=status.HTTP_202_ACCEPTED if created else status.HTTP_409_CONFLICT,
+        )
+
+    # Flipping the flag first locks the order, so it can only be completed once
+    if not Order.objects.filter(id=order.id, completed=False).update(completed=True):
+        raise exceptions.ValidationError("Order is already completed")
+
+    lines = list(order.orderitem_set.values_list("id", "widget_id", "quantity"))
+    short = reserve_stock(order_demand(lines))
+    if short:
+        # Undo the reservations that did succeed and the completed flag
+        transaction.set_rollback(True)
+        return Response(stock_errors(lines, short), status=status.HTTP_400_BAD_REQUEST)
     return Response()
 
 
-@api_view(["GET", "POST", "PUT", "DELETE"])
+@api_view(["GET"])
+def checkout_job(request, job_id):
+    """
+    Status of a queued checkout. Failed jobs carry the errors a synchronous
+    checkout would have returned.
+    """
+    try:
+        job = CheckoutJob.objects.select_related("order").get(id=job_id)
+    except CheckoutJob.DoesNotExist:
+        raise exceptions.NotFound("Checkout job does not exist")
+    return Response(CheckoutJobSerializer(job).data)
+
+
+@api_view(["GET", "POST", "PUT", "PATCH", "DELETE"])
+@renderer_classes(CATALOG_RENDERERS)
 def order_item(request, order_item_id):
     if request.method == "GET":
         if not order_item_id:
             raise exceptions.NotAuthenticated
-        order_item = OrderItem.objects.get(id=order_item_id)
-        return Response(OrderItemSerializer(order_item).data)
+        order_item = OrderItem.objects.select_related("widget__category").prefetch_related("widget__features").get(
+            id=order_item_id
+        )
+        return Response(OrderItemSerializer(order_item).data, headers={"ETag": version_etag(order_item)})
     elif request.method == "POST":
         serializer = OrderItemSerializer(data=request.data)
         if serializer.is_valid():
@@ -126,16 +488,18 @@ def order_item(request, order_item_id):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-    elif request.method == "PUT":
+    elif request.method in ("PUT", "PATCH"):
         if not order_item_id:
             raise exceptions.ValidationError("Order item id necessary")
-        order_item = OrderItem.objects.get(id=order_item_id)
-        serializer = OrderItemSerializer(order_item, data=request.data)
-        if serializer.is_valid():
+        with transaction.atomic():
+            order_item = OrderItem.objects.get(id=order_item_id)
+            serializer = OrderItemSerializer(order_item, data=request.data, partial=request.method == "PATCH")
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            if not claim_version(order_item, if_match_versions(request)):
+                return precondition_failed(order_item)
             serializer.save()
-            return Response(serializer.data)
-        else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.data, headers={"ETag": version_etag(order_item)})
     elif request.method == "DELETE":
         if not order_item_id:
             raise exceptions.ValidationError("Order item id necessary")